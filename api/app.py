@@ -1,12 +1,15 @@
-import json
+import math
 import jwt
-import connect
+import connect.utils
 from flask import (
     Blueprint, Flask, jsonify, current_app as app, render_template,
     Response, request,
 )
 from pyutils import get_redis, env, defenv
 from .tunnel import TunnelManager
+from .heartbeat import HeartbeatBuffer
+from .servers import ServerListCache
+from .tokens import TokenCache
 
 bp = Blueprint('api', __name__, url_prefix='/')
 
@@ -14,13 +17,20 @@ defenv('API_SECRET_KEY', str, optional=False)
 
 
 def create_app():
+    env.get_config()
+
     app = Flask(__name__)
     app.secret_key = env.API_SECRET_KEY
     app.register_blueprint(bp)
     app.register_error_handler(404, page_not_found)
 
     app.redis = get_redis()
-    app.tunnel_manager = TunnelManager(app.redis)
+    app.heartbeats = HeartbeatBuffer(app.redis, env.TUNNEL_TTL)
+    app.heartbeats.start()
+    app.tunnel_manager = TunnelManager(app.redis, app.heartbeats)
+    app.server_list_cache = ServerListCache(app.redis)
+    app.token_cache = TokenCache()
+    app.subdomains = connect.utils.SubdomainAllocator(app.redis)
 
     return app
 
@@ -31,14 +41,7 @@ def page_not_found(e):
 
 @bp.get('/servers')
 def get_servers():
-    servers = app.redis.get('vpn:status-list')
-    if servers is not None:
-        servers = json.loads(servers)
-    else:
-        servers = []
-    return jsonify({
-        'value': servers,
-    })
+    return app.server_list_cache.get().make_response()
 
 
 @bp.get('/connect/tunnel')
@@ -62,22 +65,29 @@ def get_tunnel():
         return jsonify({'description': 'No token'}), 400
 
     try:
-        token_data = jwt.decode(
-            token, app.secret_key, algorithms=['HS256'])
+        token_data = app.token_cache.decode(token, app.secret_key)
     except jwt.InvalidTokenError:
         return jsonify({'description': 'Invalid token'}), 400
 
     if token_data['ver'] != 1:
         return jsonify({'description': 'Unsupported token'}), 500
 
-    tunnel = app.tunnel_manager.get_tunnel(token_data)
+    # with ?wait=N, a pending tunnel is held until it's ready (or
+    # rejected), for up to N seconds.
+    wait = request.args.get('wait', type=float)
+    if wait is not None and not math.isfinite(wait):
+        return jsonify({'description': 'Invalid wait'}), 400
+    if wait:
+        wait = max(0.0, min(wait, app.tunnel_manager.max_wait))
+        tunnel = app.tunnel_manager.wait_tunnel(token_data, wait)
+    else:
+        tunnel = app.tunnel_manager.get_tunnel(token_data)
     return jsonify(tunnel)
 
 
 @bp.get('/connect/token')
 def get_token():
-    tunnel_idx = app.redis.incr('connect:subdomain:idx')
-    subdomain = connect.utils.get_subdomain(tunnel_idx)
+    subdomain = app.subdomains.next_subdomain()
     return jsonify({
         'token': connect.utils.create_tunnel_token(app.secret_key, subdomain)
     })
@@ -0,0 +1,104 @@
+import time
+import atexit
+import logging
+import threading
+from pyutils import env, defenv
+
+defenv('HEARTBEAT_FLUSH_INTERVAL', float, default=0.25)
+defenv('HEARTBEAT_RECORD_MAX_AGE', int, default=60)
+
+logger = logging.getLogger(__name__)
+
+
+class HeartbeatBuffer:
+    # Coalesces the ttl refreshes of ready tunnels. Once a connector's
+    # tunnel is ready, its record does not change anymore, so a
+    # heartbeat only needs to push its expiry forward. The record is
+    # kept here and served from memory, the connector is marked as
+    # seen, and a background thread refreshes the ttl of everyone seen
+    # since its last run in one pipelined round trip. This way redis
+    # traffic depends on the flush interval rather than on the number
+    # of requests.
+    #
+    # Records are re-read from redis at least every
+    # HEARTBEAT_RECORD_MAX_AGE seconds, and dropped as soon as a flush
+    # finds they have expired.
+
+    def __init__(self, redis, ttl, interval=None, max_age=None):
+        self.redis = redis
+        self.ttl = ttl
+        self.interval = interval or env.HEARTBEAT_FLUSH_INTERVAL
+        self.max_age = max_age or env.HEARTBEAT_RECORD_MAX_AGE
+        self._records = {}
+        self._seen = set()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(
+            target=self._run, name='heartbeat-flush', daemon=True)
+        self._thread.start()
+        # don't lose the last batch when the process exits.
+        atexit.register(self.flush)
+
+    def get(self, connector_id):
+        # Returns the buffered record for the connector and marks it as
+        # seen, or None if the record has to be read from redis.
+        with self._lock:
+            entry = self._records.get(connector_id)
+            if entry is None:
+                return None
+            tunnel, stored_at = entry
+            if time.monotonic() - stored_at > self.max_age:
+                del self._records[connector_id]
+                return None
+            self._seen.add(connector_id)
+            return tunnel
+
+    def remember(self, connector_id, tunnel):
+        with self._lock:
+            self._records[connector_id] = (tunnel, time.monotonic())
+
+    def flush(self):
+        with self._lock:
+            seen, self._seen = self._seen, set()
+        if not seen:
+            return
+
+        seen = list(seen)
+        pipe = self.redis.pipeline(transaction=False)
+        for connector_id in seen:
+            pipe.expire(f'tunnel:{connector_id}', self.ttl)
+        refreshed = pipe.execute()
+
+        # records that expired in redis have to go through get_tunnel
+        # again, to be re-created.
+        with self._lock:
+            for connector_id, exists in zip(seen, refreshed):
+                if not exists:
+                    self._records.pop(connector_id, None)
+
+    def _run(self):
+        last_cleanup = time.monotonic()
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.flush()
+            except Exception:
+                logger.exception('Error flushing heartbeats')
+
+            now = time.monotonic()
+            if now - last_cleanup > self.max_age:
+                self._drop_stale(now)
+                last_cleanup = now
+
+    def _drop_stale(self, now):
+        # connectors that went away would otherwise stay here forever.
+        with self._lock:
+            stale = [
+                connector_id
+                for connector_id, (_, stored_at) in self._records.items()
+                if now - stored_at > self.max_age
+            ]
+            for connector_id in stale:
+                del self._records[connector_id]
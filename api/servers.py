@@ -0,0 +1,54 @@
+import time
+import threading
+from pyutils import env, defenv
+from pyutils.staticfiles import StaticFile
+
+defenv('SERVERS_CACHE_TTL', float, default=5.0)
+
+SERVERS_KEY = 'vpn:status-list'
+SERVERS_VERSION_KEY = 'vpn:status-list:version'
+
+
+class ServerList(StaticFile):
+    # One version of the server list, serialized and compressed once.
+
+    def __init__(self, version, servers):
+        if servers is None:
+            servers = b'[]'
+        # the list is stored as json already, so it's spliced into the
+        # response as is.
+        super().__init__(b'{"value":' + servers + b'}', 'application/json')
+        self.version = version
+
+
+class ServerListCache:
+    # Per-process cache of the server list sstester writes to redis.
+    # The list is only re-read when sstester has bumped the version,
+    # and the version itself is checked at most every
+    # SERVERS_CACHE_TTL seconds.
+
+    def __init__(self, redis):
+        self.redis = redis
+        self.ttl = env.SERVERS_CACHE_TTL
+        self._current = None
+        self._checked_at = 0
+        self._lock = threading.Lock()
+
+    def get(self):
+        if time.monotonic() - self._checked_at < self.ttl:
+            return self._current
+
+        with self._lock:
+            # someone else might have refreshed it while we waited.
+            if time.monotonic() - self._checked_at < self.ttl:
+                return self._current
+
+            version = self.redis.get(SERVERS_VERSION_KEY)
+            if self._current is None or version != self._current.version:
+                # versions only go up, so a newer version read alongside
+                # an older list just causes one extra refresh later.
+                self._current = ServerList(
+                    version, self.redis.get(SERVERS_KEY))
+            self._checked_at = time.monotonic()
+            return self._current
+
@@ -0,0 +1,56 @@
+import time
+import hashlib
+import threading
+import jwt
+from collections import OrderedDict
+from pyutils import env, defenv
+
+defenv('TOKEN_CACHE_SIZE', int, default=10000)
+defenv('TOKEN_CACHE_TTL', int, default=300)
+
+
+class TokenCache:
+    # An LRU cache of verified token claims, so that clients sending
+    # the same token with every heartbeat don't make us verify and
+    # parse it every time. Only valid tokens are cached.
+    #
+    # Entries are keyed by a hash of the secret key along with the
+    # token, so after the secret is rotated, no old entry can match
+    # and tokens are verified against the new key again.
+
+    def __init__(self, size=None, ttl=None):
+        self.size = size or env.TOKEN_CACHE_SIZE
+        self.ttl = ttl or env.TOKEN_CACHE_TTL
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def decode(self, token, secret):
+        # Same as jwt.decode with HS256, raising jwt.InvalidTokenError
+        # for invalid tokens.
+        key = hashlib.sha256(
+            secret.encode('utf-8') + b'\0' + token.encode('utf-8')
+        ).digest()
+        now = time.monotonic()
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                claims, expires_at = entry
+                if expires_at > now:
+                    self._entries.move_to_end(key)
+                    return claims
+                del self._entries[key]
+
+        claims = jwt.decode(token, secret, algorithms=['HS256'])
+
+        expires_at = now + self.ttl
+        if 'exp' in claims:
+            # don't keep serving a token past its own expiry.
+            expires_at = min(expires_at, now + claims['exp'] - time.time())
+
+        with self._lock:
+            self._entries[key] = (claims, expires_at)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+        return claims
@@ -1,38 +1,181 @@
 import json
+import time
+from redis.exceptions import ResponseError
 from pyutils import env, defenv
 
 
 defenv('TUNNEL_TTL', int, default=300)
+# queue entries a worker hasn't acknowledged for this many seconds are
+# handed to another one. this needs to be longer than
+# CONNECT_PROVISION_LEASE_TTL, so that the leases of a crashed worker
+# have expired by then.
+defenv('TUNNEL_PENDING_CLAIM_IDLE', int, default=180)
+defenv('TUNNEL_MAX_WAIT', int, default=60)
+
+# stream of connector ids waiting for a tunnel. it's deliberately not
+# under the tunnel: prefix, since everything there is expected to be a
+# json tunnel record.
+PENDING_STREAM = 'connect:pending-tunnels'
+PENDING_GROUP = 'connect-worker'
+PENDING_STREAM_MAXLEN = 100000
+
+# sorted set of connector ids whose tunnel creation failed, scored by
+# when to queue them again, and the failure count of each (which
+# expires, so counts of connectors that went away don't pile up).
+PENDING_RETRIES = 'connect:pending-retries'
+PENDING_FAILURES_PREFIX = 'connect:provision-failures:'
+PENDING_FAILURES_TTL = 3600
+
+# Moves up to ARGV[2] connectors whose retry is due at ARGV[1] from the
+# retry set (KEYS[1]) to the pending stream (KEYS[2]). Returns how many
+# were moved.
+REQUEUE_SCRIPT = '''
+local due = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1],
+                       'LIMIT', 0, ARGV[2])
+for _, connector_id in ipairs(due) do
+    redis.call('XADD', KEYS[2], 'MAXLEN', '~', ARGV[3], '*',
+               'cid', connector_id)
+end
+if #due > 0 then
+    redis.call('ZREM', KEYS[1], unpack(due))
+end
+return #due
+'''
+
+# list of ready-made tunnels (json objects with hostname, path and
+# cfd_creds) that the worker keeps topped up, and new connectors claim.
+TUNNEL_POOL = 'connect:tunnel-pool'
+
+# hash of cloudflare tunnel id -> connector id, for every tunnel record
+# that has a tunnel. entries are added along with the records, and the
+# ones whose record has expired are dropped the next time it's read.
+ACTIVE_TUNNELS = 'connect:active-tunnels'
+
+# Does everything get_tunnel needs in one round trip. If the connector
+# has a tunnel record, its ttl is refreshed and it's returned (rejected
+# connectors are queued again, to give them another chance). Otherwise
+# a tunnel from the pool is bound to the connector, or if the pool is
+# empty, a pending record is created and queued. The first element of
+# the result says which one happened.
+#
+# KEYS: tunnel record, pool, active tunnel index, pending stream
+# ARGV: tunnel name, ttl, pending record, connector id, stream maxlen
+GET_OR_CREATE_SCRIPT = '''
+local existing = redis.call('GET', KEYS[1])
+if existing then
+    redis.call('EXPIRE', KEYS[1], ARGV[2])
+    -- this runs on every heartbeat, so the record is searched rather
+    -- than parsed. the other fields can't contain this.
+    if string.find(existing, '"status":%s*"rejected"') then
+        redis.call('XADD', KEYS[4], 'MAXLEN', '~', ARGV[5], '*',
+                   'cid', ARGV[4])
+        return {'rejected', existing}
+    end
+    return {'existing', existing}
+end
+
+local pooled = redis.call('LPOP', KEYS[2])
+if pooled then
+    local tunnel = cjson.decode(pooled)
+    tunnel['tunnel_name'] = ARGV[1]
+    tunnel['status'] = 'ready'
+    local data = cjson.encode(tunnel)
+    redis.call('SET', KEYS[1], data, 'EX', ARGV[2])
+    redis.call('HSET', KEYS[3], tunnel['cfd_creds']['TunnelID'], ARGV[4])
+    return {'claimed', data}
+end
+
+-- pending records expire too, in case the connector goes away before
+-- it gets a tunnel.
+redis.call('SET', KEYS[1], ARGV[3], 'EX', ARGV[2])
+redis.call('XADD', KEYS[4], 'MAXLEN', '~', ARGV[5], '*', 'cid', ARGV[4])
+return {'pending', ARGV[3]}
+'''
 
 
 class TunnelManager:
-    def __init__(self, redis):
+    def __init__(self, redis, heartbeats=None):
         self.redis = redis
         self.tunnel_ttl = env.TUNNEL_TTL
+        self.pending_claim_idle = env.TUNNEL_PENDING_CLAIM_IDLE
+        self.max_wait = env.TUNNEL_MAX_WAIT
+        # an optional HeartbeatBuffer (see api.heartbeat), to coalesce
+        # the ttl refreshes of ready tunnels.
+        self.heartbeats = heartbeats
+        self._get_or_create = redis.register_script(GET_OR_CREATE_SCRIPT)
+        self._requeue = redis.register_script(REQUEUE_SCRIPT)
 
     def get_tunnel(self, token_data):
         connector_id = token_data['cid']
         tunnel_name = token_data['tname']
 
-        key = f'tunnel:{connector_id}'
-        tunnel = self.redis.get(key)
-        if tunnel:
-            self.redis.expire(key, self.tunnel_ttl)
-            return json.loads(tunnel)
+        if self.heartbeats is not None:
+            tunnel = self.heartbeats.get(connector_id)
+            if tunnel is not None:
+                return tunnel
 
-        # in case a tunnel is created right after we read the empty
-        # key, both writers are going to write the same value, so we
-        # don't even need to set nx=True in the set call down below.
-        tunnel = {
+        pending = {
             'tunnel_name': tunnel_name,
             'status': 'pending',
             'hostname': None,
             'path': None,
             'cfd_creds': None,
         }
-        self.redis.set(key, json.dumps(tunnel))
+
+        # this runs atomically on the server, so even with parallel
+        # calls only one of them gets to claim a pooled tunnel, or
+        # queue the connector.
+        _, tunnel = self._get_or_create(
+            keys=[f'tunnel:{connector_id}', TUNNEL_POOL, ACTIVE_TUNNELS,
+                  PENDING_STREAM],
+            args=[tunnel_name, self.tunnel_ttl, json.dumps(pending),
+                  connector_id, PENDING_STREAM_MAXLEN])
+        tunnel = json.loads(tunnel)
+        if self.heartbeats is not None and tunnel['status'] == 'ready':
+            self.heartbeats.remember(connector_id, tunnel)
+        return tunnel
+
+    def wait_tunnel(self, token_data, timeout):
+        # Like get_tunnel, but if the tunnel is still pending, wait up
+        # to `timeout` seconds for the worker to update it.
+        tunnel = self.get_tunnel(token_data)
+        if tunnel['status'] != 'pending' or timeout <= 0:
+            return tunnel
+
+        connector_id = token_data['cid']
+        deadline = time.monotonic() + min(timeout, self.max_wait)
+        pubsub = self.redis.pubsub(ignore_subscribe_messages=True)
+        try:
+            pubsub.subscribe(get_update_channel(connector_id))
+
+            # the record might have been updated before we subscribed.
+            tunnel = self.read_tunnel(connector_id) or tunnel
+            while tunnel['status'] == 'pending':
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                if pubsub.get_message(timeout=remaining) is not None:
+                    tunnel = self.read_tunnel(connector_id) or tunnel
+        finally:
+            pubsub.close()
         return tunnel
 
+    def read_tunnel(self, connector_id):
+        tunnel = self.redis.get(f'tunnel:{connector_id}')
+        if tunnel is None:
+            return None
+        return json.loads(tunnel)
+
+    def read_tunnels(self, connector_ids):
+        if not connector_ids:
+            return []
+        tunnels = self.redis.mget(
+            [f'tunnel:{connector_id}' for connector_id in connector_ids])
+        return [
+            json.loads(tunnel) if tunnel is not None else None
+            for tunnel in tunnels
+        ]
+
     def write_tunnel(self, connector_id, tunnel_name, *,
                      hostname=None, path=None, cfd_creds=None,
                      status=None, reject_reason=None):
@@ -45,5 +188,218 @@ class TunnelManager:
         }
         if reject_reason:
             data['reject_reason'] = reject_reason
-        self.redis.set(f'tunnel:{connector_id}', json.dumps(data),
-                       ex=self.tunnel_ttl)
+        pipe = self.redis.pipeline()
+        pipe.set(f'tunnel:{connector_id}', json.dumps(data),
+                 ex=self.tunnel_ttl)
+        if cfd_creds:
+            pipe.hset(ACTIVE_TUNNELS, cfd_creds['TunnelID'], connector_id)
+            pipe.delete(PENDING_FAILURES_PREFIX + connector_id)
+        # wake up anyone waiting for this tunnel in wait_tunnel.
+        pipe.publish(get_update_channel(connector_id), status or '')
+        pipe.execute()
+
+    def count_active_tunnels(self):
+        # might include a few tunnels whose record has just expired.
+        return self.redis.hlen(ACTIVE_TUNNELS)
+
+    def iter_tunnels(self, batch_size=1000):
+        # Yields (connector_id, tunnel) for every tunnel record, reading
+        # them in batches of (roughly) batch_size keys per round trip.
+        keys = []
+        for key in self.redis.scan_iter('tunnel:*', count=batch_size):
+            keys.append(key)
+            if len(keys) >= batch_size:
+                yield from self._read_tunnels(keys)
+                keys = []
+        if keys:
+            yield from self._read_tunnels(keys)
+
+    def _read_tunnels(self, keys):
+        for key, tunnel in zip(keys, self.redis.mget(keys)):
+            if tunnel is None:
+                # expired since the scan
+                continue
+            key = _decode(key)
+            _, connector_id = key.split(':', maxsplit=1)
+            yield connector_id, json.loads(tunnel)
+
+    def get_active_tunnel_ids(self):
+        # Returns the ids of the cloudflare tunnels that belong to an
+        # existing tunnel record, in two round trips regardless of the
+        # number of tunnels.
+        active = self.redis.hgetall(ACTIVE_TUNNELS)
+        if not active:
+            return set()
+
+        active = list(active.items())
+        pipe = self.redis.pipeline(transaction=False)
+        for _, connector_id in active:
+            connector_id = _decode(connector_id)
+            pipe.exists(f'tunnel:{connector_id}')
+        exists = pipe.execute()
+
+        tunnel_ids = set()
+        expired = []
+        for (tunnel_id, _), tunnel_exists in zip(active, exists):
+            tunnel_id = _decode(tunnel_id)
+            if tunnel_exists:
+                tunnel_ids.add(tunnel_id)
+            else:
+                expired.append(tunnel_id)
+        if expired:
+            self.redis.hdel(ACTIVE_TUNNELS, *expired)
+        return tunnel_ids
+
+    def add_pooled_tunnel(self, hostname, path, cfd_creds):
+        tunnel = {
+            'hostname': hostname,
+            'path': path,
+            'cfd_creds': cfd_creds,
+        }
+        self.redis.rpush(TUNNEL_POOL, json.dumps(tunnel))
+
+    def get_pooled_tunnels(self):
+        return [
+            json.loads(tunnel)
+            for tunnel in self.redis.lrange(TUNNEL_POOL, 0, -1)
+        ]
+
+    def get_pool_size(self):
+        return self.redis.llen(TUNNEL_POOL)
+
+    def enqueue_pending(self, connector_id):
+        self.redis.xadd(PENDING_STREAM, {'cid': connector_id},
+                        maxlen=PENDING_STREAM_MAXLEN, approximate=True)
+
+    def create_pending_group(self):
+        try:
+            self.redis.xgroup_create(PENDING_STREAM, PENDING_GROUP,
+                                     id='0', mkstream=True)
+        except ResponseError as e:
+            if 'BUSYGROUP' not in str(e):
+                raise
+
+    def index_existing_tunnels(self):
+        # Queue every pending record, and index every provisioned one,
+        # that is already in redis. This is only needed once at
+        # start-up, for records created before the queue and the index
+        # existed, or while the stream was being trimmed.
+        pending = 0
+        active = {}
+        for connector_id, tunnel in self.iter_tunnels():
+            if tunnel['hostname'] is None:
+                self.enqueue_pending(connector_id)
+                pending += 1
+            elif tunnel.get('cfd_creds'):
+                active[tunnel['cfd_creds']['TunnelID']] = connector_id
+        if active:
+            self.redis.hset(ACTIVE_TUNNELS, mapping=active)
+        return pending, len(active)
+
+    def read_pending(self, consumer, block=None, count=100):
+        # Returns a list of (entry_id, connector_id) tuples. Entries
+        # that another consumer read but never acknowledged (because
+        # it crashed half-way, for example) are re-claimed first,
+        # then we block for up to `block` milliseconds for new ones.
+        #
+        # only the ids are claimed: redis 6.2 returns entries trimmed
+        # from the stream as nil, without their ids, so they could
+        # never be acknowledged (redis 7 leaves them out and drops
+        # them itself).
+        claimed = self.redis.xautoclaim(
+            PENDING_STREAM, PENDING_GROUP, consumer,
+            min_idle_time=self.pending_claim_idle * 1000,
+            start_id='0-0', count=count, justid=True)
+        if claimed:
+            pipe = self.redis.pipeline(transaction=False)
+            for entry_id in claimed:
+                pipe.xrange(PENDING_STREAM, min=entry_id, max=entry_id)
+            entries = [
+                found[0] if found else (entry_id, None)
+                for entry_id, found in zip(claimed, pipe.execute())
+            ]
+        else:
+            streams = self.redis.xreadgroup(
+                PENDING_GROUP, consumer, {PENDING_STREAM: '>'},
+                count=count, block=block)
+            entries = streams[0][1] if streams else []
+
+        result = []
+        for entry_id, fields in entries:
+            if not fields:
+                # the entry was trimmed from the stream before we got
+                # to it; index_existing_tunnels takes care of such records.
+                self.ack_pending(entry_id)
+                continue
+            connector_id = fields.get('cid', fields.get(b'cid'))
+            connector_id = _decode(connector_id)
+            result.append((entry_id, connector_id))
+        return result
+
+    def retry_pending(self, entry_id, connector_id, delay, max_delay):
+        # Acknowledges a queue entry whose tunnel couldn't be created,
+        # and queues the connector again after `delay` seconds, doubled
+        # for every failure in a row, up to `max_delay`. Returns the
+        # delay.
+        failures_key = PENDING_FAILURES_PREFIX + connector_id
+        pipe = self.redis.pipeline()
+        pipe.incr(failures_key)
+        pipe.expire(failures_key, PENDING_FAILURES_TTL)
+        failures, _ = pipe.execute()
+
+        delay = min(max_delay, delay * 2 ** min(failures - 1, 16))
+        pipe = self.redis.pipeline()
+        pipe.zadd(PENDING_RETRIES, {connector_id: time.time() + delay})
+        pipe.xack(PENDING_STREAM, PENDING_GROUP, entry_id)
+        pipe.execute()
+        return delay
+
+    def requeue_due_retries(self, count=1000):
+        return self._requeue(
+            keys=[PENDING_RETRIES, PENDING_STREAM],
+            args=[time.time(), count, PENDING_STREAM_MAXLEN])
+
+    def get_pending_stats(self):
+        # Returns the number of connectors in the queue (delivered to a
+        # worker or not, as long as they're not acknowledged yet, or
+        # waiting for a retry), and the age in seconds of the oldest
+        # queue entry.
+        groups = self.redis.xinfo_groups(PENDING_STREAM)
+        group = next(
+            (g for g in groups if _decode(g['name']) == PENDING_GROUP),
+            None)
+        if group is None:
+            return 0, 0.0
+
+        summary = self.redis.xpending(PENDING_STREAM, PENDING_GROUP)
+        oldest = []
+        if summary['pending']:
+            oldest.append(_decode(summary['min']))
+        undelivered = self.redis.xrange(
+            PENDING_STREAM,
+            min='(' + _decode(group['last-delivered-id']),
+            max='+', count=1)
+        if undelivered:
+            oldest.append(_decode(undelivered[0][0]))
+
+        depth = summary['pending'] + (group.get('lag') or 0) + \
+            self.redis.zcard(PENDING_RETRIES)
+        if not oldest:
+            return depth, 0.0
+        # stream entry ids start with their creation time in ms.
+        oldest_ms = min(int(entry_id.split('-')[0]) for entry_id in oldest)
+        return depth, max(0.0, time.time() - oldest_ms / 1000)
+
+    def ack_pending(self, *entry_ids):
+        if entry_ids:
+            self.redis.xack(PENDING_STREAM, PENDING_GROUP, *entry_ids)
+
+
+def get_update_channel(connector_id):
+    return f'tunnel-updates:{connector_id}'
+
+
+def _decode(value):
+    if isinstance(value, bytes):
+        return value.decode('ascii')
+    return value
@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+
+# Heartbeats per second a single api worker can push through
+# TunnelManager.get_tunnel, with the old GET + EXPIRE approach, with
+# the single round trip script, and with heartbeats coalesced by a
+# HeartbeatBuffer.
+#
+# Uses a scratch redis database (see bench.fixtures):
+#
+#     REDIS_MAIN=localhost python -m bench.api_heartbeat
+
+import json
+import time
+import argparse
+from api.tunnel import TunnelManager
+from api.heartbeat import HeartbeatBuffer
+from .fixtures import (
+    SCRATCH_DB, get_scratch_redis, make_token_data, add_ready_tunnels,
+)
+
+
+def legacy_get_tunnel(redis, ttl, token_data):
+    # what TunnelManager.get_tunnel used to do for an existing record.
+    key = f'tunnel:{token_data["cid"]}'
+    tunnel = redis.get(key)
+    if tunnel:
+        redis.expire(key, ttl)
+        return json.loads(tunnel)
+    raise RuntimeError('Tunnel record missing')
+
+
+def measure(name, func, tokens, duration):
+    count = 0
+    start = time.monotonic()
+    deadline = start + duration
+    while time.monotonic() < deadline:
+        for token_data in tokens:
+            func(token_data)
+        count += len(tokens)
+    elapsed = time.monotonic() - start
+    print(f'{name:>8}: {count / elapsed:8.0f} heartbeats/s')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--connectors', type=int, default=1000)
+    parser.add_argument('--duration', type=float, default=10.0)
+    parser.add_argument('--db', type=int, default=SCRATCH_DB)
+    args = parser.parse_args()
+
+    # the api uses a client without decode_responses.
+    redis = get_scratch_redis(args.db)
+    tunnel_mng = TunnelManager(redis)
+    tokens = [make_token_data(i) for i in range(args.connectors)]
+    add_ready_tunnels(tunnel_mng, tokens)
+
+    measure(
+        'legacy',
+        lambda t: legacy_get_tunnel(redis, tunnel_mng.tunnel_ttl, t),
+        tokens, args.duration)
+    measure('script', tunnel_mng.get_tunnel, tokens, args.duration)
+
+    heartbeats = HeartbeatBuffer(redis, tunnel_mng.tunnel_ttl)
+    heartbeats.start()
+    buffered_mng = TunnelManager(redis, heartbeats)
+    measure('buffered', buffered_mng.get_tunnel, tokens, args.duration)
+    heartbeats.flush()
+
+    redis.flushdb()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,172 @@
+#!/usr/bin/env python3
+
+# Load test for the api under the different gunicorn worker classes.
+# For each mode, gunicorn is started the way manifest.yaml runs it (but
+# with the worker class of that mode), and a few thousand concurrent
+# clients keep heartbeating on /connect/tunnel and fetching /servers.
+# Optionally, some of the clients long-poll a tunnel that never gets
+# ready (?wait=N), like connectors waiting for the worker do; these are
+# the requests that tie up the sync workers.
+#
+# Uses a scratch redis database (see bench.fixtures):
+#
+#     REDIS_MAIN=localhost python -m bench.api_load --clients 2000 --waiters 200
+
+from gevent import monkey
+monkey.patch_all()
+
+import os
+import sys
+import time
+import argparse
+import subprocess
+import jwt
+import gevent
+import requests
+from api.tunnel import TunnelManager
+from connect.utils import create_tunnel_token
+from .fixtures import SCRATCH_DB, get_scratch_redis, add_ready_tunnels
+
+SECRET_KEY = 'bench-secret-key'
+
+MODES = {
+    'sync': ['--workers', '{workers}'],
+    'gthread': ['--workers', '{workers}', '--threads', '32'],
+    'gevent': ['--workers', '{workers}', '-k', 'gevent',
+               '--worker-connections', '4000'],
+}
+
+
+def populate(redis, count):
+    # tokens for connectors that already have a ready tunnel.
+    tokens = [
+        create_tunnel_token(SECRET_KEY, f't-{i}') for i in range(count)
+    ]
+    add_ready_tunnels(TunnelManager(redis), [
+        jwt.decode(token, SECRET_KEY, algorithms=['HS256'])
+        for token in tokens
+    ])
+    redis.set('vpn:status-list', b'[]')
+    return tokens
+
+
+def start_server(mode, workers, port, db):
+    args = [arg.format(workers=workers) for arg in MODES[mode]]
+    proc_env = dict(os.environ,
+                    API_SECRET_KEY=SECRET_KEY,
+                    REDIS_DB=str(db))
+    proc = subprocess.Popen(
+        [sys.executable, '-m', 'gunicorn', 'api.app:create_app()',
+         '-b', f'127.0.0.1:{port}', *args],
+        env=proc_env,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL)
+
+    url = f'http://127.0.0.1:{port}'
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        try:
+            requests.get(f'{url}/servers', timeout=1)
+            return proc, url
+        except requests.RequestException:
+            time.sleep(0.2)
+    proc.terminate()
+    raise RuntimeError(f'gunicorn ({mode}) did not come up')
+
+
+class Client:
+    def __init__(self, url, token, deadline, path, params=None):
+        self.url = url + path
+        self.token = token
+        self.deadline = deadline
+        self.params = params or {}
+        self.latencies = []
+        self.errors = 0
+
+    def run(self):
+        session = requests.Session()
+        headers = {}
+        if self.token is not None:
+            headers['Authorization'] = f'Bearer {self.token}'
+        while time.monotonic() < self.deadline:
+            start = time.perf_counter()
+            try:
+                resp = session.get(self.url, headers=headers,
+                                   params=self.params, timeout=60)
+                resp.raise_for_status()
+            except requests.RequestException:
+                self.errors += 1
+                gevent.sleep(0.1)
+                continue
+            self.latencies.append(time.perf_counter() - start)
+
+
+def percentile(values, p):
+    if not values:
+        return float('nan')
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def run_load(url, tokens, clients, waiters, duration):
+    deadline = time.monotonic() + duration
+    workers = []
+    for i in range(clients):
+        if i % 10 == 0:
+            workers.append(Client(url, None, deadline, '/servers'))
+        else:
+            token = tokens[i % len(tokens)]
+            workers.append(Client(url, token, deadline, '/connect/tunnel'))
+    waiting = [
+        # new tokens, so the tunnels stay pending
+        Client(url, create_tunnel_token(SECRET_KEY, f'w-{i}'), deadline,
+               '/connect/tunnel', params={'wait': 30})
+        for i in range(waiters)
+    ]
+
+    start = time.monotonic()
+    greenlets = [gevent.spawn(c.run) for c in workers + waiting]
+    gevent.joinall(greenlets)
+    elapsed = time.monotonic() - start
+
+    latencies = [t for c in workers for t in c.latencies]
+    errors = sum(c.errors for c in workers)
+    return len(latencies) / elapsed, latencies, errors
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--modes', nargs='+', choices=list(MODES),
+                        default=list(MODES))
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--clients', type=int, default=1000)
+    parser.add_argument('--waiters', type=int, default=0)
+    parser.add_argument('--connectors', type=int, default=1000)
+    parser.add_argument('--duration', type=float, default=20.0)
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--db', type=int, default=SCRATCH_DB)
+    args = parser.parse_args()
+
+    redis = get_scratch_redis(args.db)
+    tokens = populate(redis, args.connectors)
+
+    print(f'{args.clients} clients, {args.waiters} long-polling, '
+          f'{args.workers} workers')
+    for mode in args.modes:
+        proc, url = start_server(mode, args.workers, args.port, args.db)
+        try:
+            rate, latencies, errors = run_load(
+                url, tokens, args.clients, args.waiters, args.duration)
+        finally:
+            proc.terminate()
+            proc.wait()
+        print(f'{mode:>8}: {rate:8.0f} req/s  '
+              f'p50 {percentile(latencies, 0.5) * 1000:7.1f}ms  '
+              f'p99 {percentile(latencies, 0.99) * 1000:7.1f}ms  '
+              f'errors {errors}')
+
+    redis.flushdb()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,208 @@
+#!/usr/bin/env python3
+
+# Load test for connect.worker against the fake Cloudflare API in
+# connect.fakecf. Simulates connectors that ask for a tunnel (the way
+# the api does on /connect/tunnel) until it's ready, and then keep
+# heartbeating, while the worker runs in a background thread.
+#
+# Uses a scratch redis database (see bench.fixtures):
+#
+#     REDIS_MAIN=localhost python -m bench.connect_load --connectors 2000
+
+import os
+import time
+import heapq
+import argparse
+import threading
+import importlib
+from uuid import uuid4
+from pyutils import config_logging
+from api.tunnel import TunnelManager, TUNNEL_POOL
+from connect.fakecf import FakeCloudflare
+from .fixtures import SCRATCH_DB, get_scratch_redis
+
+
+class Connector:
+    def __init__(self, start_time):
+        self.token_data = {
+            'ver': 1,
+            'cid': str(uuid4()),
+            'tname': 't-' + uuid4().hex[:13],
+        }
+        self.start_time = start_time
+        self.ready_time = None
+
+
+class Simulation:
+    def __init__(self, tunnel_mng, connectors, poll_interval,
+                 heartbeat_interval, reject_interval):
+        self.tunnel_mng = tunnel_mng
+        self.connectors = connectors
+        self.poll_interval = poll_interval
+        self.heartbeat_interval = heartbeat_interval
+        self.reject_interval = reject_interval
+        self.requests = 0
+        self.rejections = 0
+        self._queue = [
+            (c.start_time, i) for i, c in enumerate(connectors)
+        ]
+        heapq.heapify(self._queue)
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+
+    def run(self, threads):
+        workers = [
+            threading.Thread(target=self._drive, daemon=True)
+            for _ in range(threads)
+        ]
+        for t in workers:
+            t.start()
+        return workers
+
+    def stop(self):
+        self._stop.set()
+
+    def ready_count(self):
+        return sum(1 for c in self.connectors if c.ready_time is not None)
+
+    def _drive(self):
+        while not self._stop.is_set():
+            with self._lock:
+                due, idx = self._queue[0] if self._queue else (None, None)
+                if due is not None and due <= time.monotonic():
+                    heapq.heappop(self._queue)
+                else:
+                    idx = None
+            if idx is None:
+                time.sleep(0.005)
+                continue
+
+            connector = self.connectors[idx]
+            tunnel = self.tunnel_mng.get_tunnel(connector.token_data)
+            now = time.monotonic()
+            with self._lock:
+                self.requests += 1
+                if tunnel['status'] == 'ready':
+                    if connector.ready_time is None:
+                        connector.ready_time = now
+                    next_time = now + self.heartbeat_interval
+                elif tunnel['status'] == 'rejected':
+                    self.rejections += 1
+                    next_time = now + self.reject_interval
+                else:
+                    next_time = now + self.poll_interval
+                heapq.heappush(self._queue, (next_time, idx))
+
+
+def percentile(values, p):
+    if not values:
+        return float('nan')
+    values = sorted(values)
+    k = min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))
+    return values[k]
+
+
+def redis_commands(redis):
+    return redis.info('stats')['total_commands_processed']
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--connectors', type=int, default=2000)
+    parser.add_argument('--ramp', type=float, default=10.0,
+                        help='seconds over which connectors arrive')
+    parser.add_argument('--duration', type=float, default=60.0)
+    parser.add_argument('--threads', type=int, default=32,
+                        help='threads simulating connectors')
+    parser.add_argument('--poll-interval', type=float, default=1.0)
+    parser.add_argument('--heartbeat-interval', type=float, default=15.0)
+    parser.add_argument('--cf-latency', type=float, default=0.15)
+    parser.add_argument('--cf-latency-jitter', type=float, default=0.1)
+    parser.add_argument('--cf-error-rate', type=float, default=0.0)
+    parser.add_argument('--cf-throttle-rate', type=float, default=0.0)
+    parser.add_argument('--cf-rate', type=float, default=1000.0,
+                        help='client-side cf api rate limit (calls/s)')
+    parser.add_argument('--max-tunnels', type=int, default=100000)
+    parser.add_argument('--pool-size', type=int, default=10)
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--db', type=int, default=SCRATCH_DB)
+    parser.add_argument('--log-level', default='WARNING')
+    args = parser.parse_args()
+
+    # the worker reads some of its settings at import time.
+    os.environ.setdefault('CLOUDFLARE_ACCOUNT_ID', 'fake-account')
+    os.environ.setdefault('CLOUDFLARE_ZONE_ID', 'fake-zone')
+    os.environ.setdefault('CONNECT_DOMAIN', 'example.com')
+    os.environ['CLOUDFLARE_API_RATE'] = str(args.cf_rate)
+    os.environ['CLOUDFLARE_API_BURST'] = str(int(args.cf_rate))
+    os.environ['MAX_CF_TUNNELS'] = str(args.max_tunnels)
+    os.environ['CONNECT_TUNNEL_POOL_SIZE'] = str(args.pool_size)
+    os.environ['CONNECT_PROVISION_CONCURRENCY'] = str(args.concurrency)
+
+    config_logging(args.log_level)
+    worker = importlib.import_module('connect.worker')
+
+    redis = get_scratch_redis(args.db, decode_responses=True)
+
+    fake = FakeCloudflare(
+        latency=args.cf_latency,
+        latency_jitter=args.cf_latency_jitter,
+        error_rate=args.cf_error_rate,
+        throttle_rate=args.cf_throttle_rate)
+    worker.cf_factory = fake.client
+
+    worker_thread = threading.Thread(
+        target=worker.run, args=(redis,), daemon=True)
+    worker_thread.start()
+
+    # give the worker a moment to fill the pool, like it would have in
+    # a running deployment.
+    while redis.llen(TUNNEL_POOL) < args.pool_size:
+        time.sleep(0.1)
+
+    start = time.monotonic()
+    connectors = [
+        Connector(start + args.ramp * i / args.connectors)
+        for i in range(args.connectors)
+    ]
+    sim = Simulation(
+        TunnelManager(redis), connectors,
+        args.poll_interval, args.heartbeat_interval, 60.0)
+
+    commands_before = redis_commands(redis)
+    cf_calls_before = fake.total_calls()
+    tunnels_before = len(fake.tunnels)
+
+    print(f'Simulating {args.connectors} connector(s) for '
+          f'{args.duration:.0f}s...')
+    sim.run(args.threads)
+    time.sleep(args.duration)
+    sim.stop()
+    elapsed = time.monotonic() - start
+
+    commands = redis_commands(redis) - commands_before
+    cf_calls = fake.total_calls() - cf_calls_before
+    provisioned = len(fake.tunnels) - tunnels_before
+
+    worker.keep_running = False
+    worker_thread.join()
+
+    ttr = [
+        c.ready_time - c.start_time
+        for c in connectors if c.ready_time is not None
+    ]
+    print(f'ready: {len(ttr)} of {args.connectors} connector(s), '
+          f'{sim.rejections} rejection(s), {sim.requests} request(s)')
+    print('time to ready (s): ' + ', '.join(
+        f'p{p}={percentile(ttr, p):.3f}' for p in (50, 90, 99, 100)))
+    print(f'cf api calls: {cf_calls} in total, '
+          f'{cf_calls / max(provisioned, 1):.2f} per provisioned tunnel')
+    print(f'cf api calls by endpoint: {dict(fake.calls)}')
+    print(f'injected faults: {dict(fake.injected)}')
+    print(f'redis: {commands / elapsed:.0f} ops/s')
+
+    redis.flushdb()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+
+# Requests per second a single connect.website worker can serve on /
+# and /docker-compose.yml, with the compiled pages and the credential
+# pool, against rendering everything on every request the way the
+# routes used to. Requests go through flask's test client, so this
+# includes flask's own overhead but not gunicorn's.
+#
+# Uses a scratch redis database (see bench.fixtures):
+#
+#     REDIS_MAIN=localhost python -m bench.connect_website
+
+import os
+import time
+import argparse
+
+os.environ.setdefault('WEBSITE_SECRET_KEY', 'bench-secret-key')
+os.environ.setdefault('ONE_VERSION', 'bench')
+os.environ.setdefault('CONNECT_SUBDOMAIN_SEED', '12345678901234567890')
+
+from flask import current_app, render_template
+from pyutils import env
+from connect import utils
+from connect.website import create_app, render_compose_file
+from .fixtures import SCRATCH_DB
+
+
+def legacy_get_compose_file():
+    # what the website used to do for every page view: mint a token
+    # and a password on the spot.
+    subdomain = current_app.subdomains.next_subdomain()
+    return render_compose_file(
+        utils.create_tunnel_token(current_app.secret_key, subdomain),
+        utils.create_ss_password())
+
+
+def legacy_home_page():
+    compose_code = legacy_get_compose_file()
+    return render_template(
+        'index.html',
+        docker_compose_code=compose_code,
+    )
+
+
+def legacy_compose_file():
+    return legacy_get_compose_file()
+
+
+def measure(name, client, path, count):
+    start = time.perf_counter()
+    for _ in range(count):
+        resp = client.get(path)
+        assert resp.status_code == 200
+    elapsed = time.perf_counter() - start
+    print(f'{name:>24}: {count / elapsed:8.0f} req/s')
+
+
+def wait_for_pool(app):
+    # the pool is only topped up once it's half empty, so nudge it.
+    app.credentials._wakeup.set()
+    while len(app.credentials._pool) < app.credentials.size:
+        time.sleep(0.05)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--requests', type=int, default=5000)
+    parser.add_argument('--db', type=int, default=SCRATCH_DB)
+    args = parser.parse_args()
+
+    os.environ['REDIS_DB'] = str(args.db)
+    app = create_app()
+    app.redis.flushdb()
+    app.add_url_rule('/legacy', view_func=legacy_home_page)
+    app.add_url_rule('/legacy.yml', view_func=legacy_compose_file)
+    client = app.test_client()
+
+    pool_size = app.credentials.size
+    print(f'credential pool size: {pool_size}, '
+          f'subdomain block size: {app.subdomains.block_size}, '
+          f'redis db: {env.REDIS_DB}')
+
+    measure('legacy /', client, '/legacy', args.requests)
+    measure('legacy compose', client, '/legacy.yml', args.requests)
+
+    # with a full pool, up to its size...
+    wait_for_pool(app)
+    measure('/ (pool full)', client, '/', pool_size)
+    wait_for_pool(app)
+    measure('compose (pool full)', client, '/docker-compose.yml', pool_size)
+
+    # ...and sustained, with the pool refilling alongside.
+    measure('/ (sustained)', client, '/', args.requests)
+    measure('compose (sustained)', client, '/docker-compose.yml',
+            args.requests)
+
+    app.redis.flushdb()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,44 @@
+# Set-up shared by the benchmarks.
+#
+# Most of them need a redis server they can write to, and flush the
+# database they use (SCRATCH_DB, unless told otherwise with --db)
+# before and after a run, so don't point them at anything you care
+# about. The server is the one in REDIS_MAIN:
+#
+#     REDIS_MAIN=localhost python -m bench.<name>
+
+from uuid import uuid4
+from redis import Redis
+from pyutils import env
+
+SCRATCH_DB = 15
+
+
+def get_scratch_redis(db=SCRATCH_DB, decode_responses=False):
+    # Returns a client for the given database, emptied.
+    redis = Redis(host=env.REDIS_MAIN, db=db,
+                  decode_responses=decode_responses)
+    redis.flushdb()
+    return redis
+
+
+def make_token_data(i):
+    # The claims of a connector token, like connect.utils makes them.
+    return {'ver': 1, 'cid': str(uuid4()), 'tname': f't-{i}'}
+
+
+def add_ready_tunnels(tunnel_mng, tokens_data):
+    # Writes a ready tunnel record (with made-up credentials) for each
+    # of the given token claims.
+    for token_data in tokens_data:
+        tunnel_name = token_data['tname']
+        tunnel_mng.write_tunnel(
+            token_data['cid'], tunnel_name,
+            hostname=f'{tunnel_name}.example.com',
+            path='graphql',
+            cfd_creds={
+                'AccountTag': 'account',
+                'TunnelID': str(uuid4()),
+                'TunnelSecret': 'secret',
+            },
+            status='ready')
@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+
+# Checks TunnelManager's pending queue against a real redis server
+# (6.2 or later, for XAUTOCLAIM): new entries are delivered, entries a
+# crashed consumer never acknowledged are re-claimed once they have
+# been idle long enough, and trimmed entries are skipped. The reply
+# formats differ between redis versions, so run this against the
+# version that is deployed.
+#
+# Uses a scratch redis database (see bench.fixtures):
+#
+#     REDIS_MAIN=localhost python -m bench.pending_queue
+
+import time
+import argparse
+from api.tunnel import TunnelManager, PENDING_STREAM, PENDING_GROUP
+from .fixtures import SCRATCH_DB, get_scratch_redis
+
+
+def check(name, condition):
+    print(f'{"ok" if condition else "FAILED":>6}: {name}')
+    return condition
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--db', type=int, default=SCRATCH_DB)
+    parser.add_argument('--claim-idle', type=int, default=1)
+    args = parser.parse_args()
+
+    redis = get_scratch_redis(args.db, decode_responses=True)
+    print(f'Redis {redis.info("server")["redis_version"]}')
+    tunnel_mng = TunnelManager(redis)
+    tunnel_mng.pending_claim_idle = args.claim_idle
+    tunnel_mng.create_pending_group()
+
+    ok = True
+
+    ok &= check('empty queue',
+                tunnel_mng.read_pending('a', block=100) == [])
+
+    for connector_id in ('c1', 'c2', 'c3'):
+        tunnel_mng.enqueue_pending(connector_id)
+    entries = tunnel_mng.read_pending('a', block=100)
+    ok &= check('new entries are delivered',
+                [cid for _, cid in entries] == ['c1', 'c2', 'c3'])
+    ok &= check('delivered entries are not delivered again',
+                tunnel_mng.read_pending('b', block=100) == [])
+
+    # 'a' crashes without acknowledging anything, and c3's entry is
+    # trimmed from the stream in the meantime.
+    tunnel_mng.ack_pending(entries[0][0])
+    redis.xdel(PENDING_STREAM, entries[2][0])
+    time.sleep(args.claim_idle + 0.1)
+    reclaimed = tunnel_mng.read_pending('b', block=100)
+    ok &= check('idle entries are re-claimed, trimmed ones skipped',
+                reclaimed == [entries[1]])
+    tunnel_mng.ack_pending(*[entry_id for entry_id, _ in reclaimed])
+    ok &= check('nothing is left pending',
+                redis.xpending(PENDING_STREAM, PENDING_GROUP)['pending']
+                == 0)
+
+    tunnel_mng.enqueue_pending('c4')
+    ok &= check('new entries are delivered after a re-claim',
+                [cid for _, cid in tunnel_mng.read_pending('b', block=100)]
+                == ['c4'])
+
+    redis.flushdb()
+    if not ok:
+        raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+
+# Cost of generating tunnel sub-domains: connect.utils.lcg against the
+# old closed-form implementation (which works on a**n as a big integer)
+# at growing indices, and get_subdomains against one get_subdomain call
+# per index. The old and new sequences are checked to be identical
+# along the way.
+#
+# Doesn't need redis:
+#
+#     python -m bench.subdomains
+
+import os
+import time
+import argparse
+
+# any seed will do, but the same one has to be used for both.
+os.environ.setdefault('CONNECT_SUBDOMAIN_SEED', '12345678901234567890')
+
+from pyutils import env
+from connect import utils
+
+
+def legacy_lcg(n):
+    # connect.utils.lcg as it used to be.
+    a = 6364136223846793005
+    c = 1442695040888963407
+    m = 2 ** 64
+    x0 = env.CONNECT_SUBDOMAIN_SEED
+    return (((a**n * x0) % m) + ((a**n - 1) % ((a - 1) * m)) // (a - 1) * c) % m
+
+
+def timeit(func, *args, repeat=1):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        result = func(*args)
+    return (time.perf_counter() - start) / repeat, result
+
+
+def bench_lcg(max_legacy_exp, max_exp):
+    print('single index:')
+    for exp in range(1, max_exp + 1):
+        n = 10 ** exp
+        new_time, new = timeit(utils.lcg, n, repeat=1000)
+        line = f'  n=10^{exp:<2} lcg {new_time * 1e6:8.1f}us'
+        if exp <= max_legacy_exp:
+            old_time, old = timeit(legacy_lcg, n)
+            assert old == new, f'lcg({n}) differs'
+            line += f'  legacy {old_time * 1e6:12.1f}us'
+        print(line)
+
+
+def bench_batch(start, count):
+    print(f'{count} consecutive sub-domains from {start}:')
+    one_time, one = timeit(
+        lambda: [utils.get_subdomain(i) for i in range(start, start + count)])
+    print(f'  get_subdomain  {one_time * 1000:8.1f}ms')
+
+    numpy = utils.numpy
+    utils.numpy = None
+    try:
+        python_time, python = timeit(utils.get_subdomains, start, count)
+    finally:
+        utils.numpy = numpy
+    assert python == one, 'get_subdomains differs'
+    print(f'  get_subdomains {python_time * 1000:8.1f}ms')
+
+    if numpy is not None:
+        numpy_time, vectorized = timeit(utils.get_subdomains, start, count)
+        assert vectorized == one, 'get_subdomains (numpy) differs'
+        print(f'  numpy          {numpy_time * 1000:8.1f}ms')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--max-exp', type=int, default=18)
+    parser.add_argument('--max-legacy-exp', type=int, default=6)
+    parser.add_argument('--batch-start', type=int, default=10 ** 6)
+    parser.add_argument('--batch-count', type=int, default=100000)
+    args = parser.parse_args()
+
+    bench_lcg(args.max_legacy_exp, args.max_exp)
+    bench_batch(args.batch_start, args.batch_count)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+
+# Counts the redis round trips one iteration of the connect worker's
+# reconciliation loop needs, with the old scan-and-get approach and
+# with the active tunnel index.
+#
+# Uses a scratch redis database (see bench.fixtures):
+#
+#     REDIS_MAIN=localhost python -m bench.worker_redis --tunnels 10000
+
+import json
+import time
+import argparse
+from uuid import uuid4
+from redis.connection import Connection
+from api.tunnel import TunnelManager
+from .fixtures import (
+    SCRATCH_DB, get_scratch_redis, make_token_data, add_ready_tunnels,
+)
+
+
+round_trips = 0
+_send_packed_command = Connection.send_packed_command
+
+
+def counting_send_packed_command(self, *args, **kwargs):
+    # a pipeline sends all of its commands in one go, so this is
+    # called once per round trip.
+    global round_trips
+    round_trips += 1
+    return _send_packed_command(self, *args, **kwargs)
+
+
+Connection.send_packed_command = counting_send_packed_command
+
+
+def populate(redis, tunnel_mng, count, pending_ratio):
+    pending = int(count * pending_ratio)
+    pipe = redis.pipeline(transaction=False)
+    for i in range(pending):
+        pipe.set(f'tunnel:{uuid4()}', json.dumps({
+            'tunnel_name': f't-{i}',
+            'status': 'pending',
+            'hostname': None,
+            'path': None,
+            'cfd_creds': None,
+        }))
+    pipe.execute()
+    add_ready_tunnels(
+        tunnel_mng, [make_token_data(i) for i in range(pending, count)])
+
+
+def legacy_iteration(redis):
+    # what connect.worker.main used to do on every iteration: scan for
+    # pending records, then scan again and read every record for its
+    # tunnel id.
+    pending = 0
+    for key in redis.scan_iter('tunnel:*'):
+        tunnel = json.loads(redis.get(key))
+        if tunnel['hostname'] is None:
+            pending += 1
+
+    active = set()
+    for key in redis.scan_iter('tunnel:*'):
+        _, connector_id = key.split(':', maxsplit=1)
+        tunnel = json.loads(redis.get(f'tunnel:{connector_id}'))
+        cfd_creds = tunnel.get('cfd_creds') or {}
+        if cfd_creds.get('TunnelID'):
+            active.add(cfd_creds['TunnelID'])
+    return active
+
+
+def indexed_iteration(tunnel_mng):
+    return tunnel_mng.get_active_tunnel_ids()
+
+
+def measure(name, func, *args):
+    global round_trips
+    round_trips = 0
+    start = time.monotonic()
+    result = func(*args)
+    elapsed = time.monotonic() - start
+    print(f'{name:>10}: {round_trips:>6} round trip(s), '
+          f'{elapsed * 1000:8.1f} ms, {len(result)} active tunnel(s)')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--tunnels', type=int, default=10000)
+    parser.add_argument('--pending-ratio', type=float, default=0.01)
+    parser.add_argument('--db', type=int, default=SCRATCH_DB)
+    args = parser.parse_args()
+
+    redis = get_scratch_redis(args.db, decode_responses=True)
+    tunnel_mng = TunnelManager(redis)
+
+    print(f'Populating {args.tunnels} tunnel record(s)...')
+    populate(redis, tunnel_mng, args.tunnels, args.pending_ratio)
+
+    measure('legacy', legacy_iteration, redis)
+    measure('indexed', indexed_iteration, tunnel_mng)
+
+    redis.flushdb()
+
+
+if __name__ == '__main__':
+    main()
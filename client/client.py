@@ -26,6 +26,9 @@ ingress:
 
 api_hostname = 'https://grimpen.one/api/v1'
 
+# how long the api holds our request for a tunnel that is not ready yet.
+tunnel_wait_time = 30
+
 cf_config_file = f'{env.CLIENT_OUTPUT_DIR}/cfd-config.yml'
 cf_creds_file = f'{env.CLIENT_OUTPUT_DIR}/cfd-creds.json'
 
@@ -40,6 +43,7 @@ def cleanup_old_files():
 
 def main():
     config_logging()
+    env.get_config()
 
     web.launch_web_ui()
 
@@ -54,8 +58,11 @@ def main():
 
     logger.info('Requesting tunnel...')
     while True:
+        start_time = time.monotonic()
         resp = session.get(
-            f'{api_hostname}/connect/tunnel')
+            f'{api_hostname}/connect/tunnel',
+            params={'wait': tunnel_wait_time},
+            timeout=tunnel_wait_time + 15)
         if 400 <= resp.status_code < 500:
             try:
                 error = resp.json()
@@ -85,7 +92,7 @@ def main():
                 reason = f'Reason: {reason}'
             else:
                 reason = ''
-            logger.warning('Server rejected tunnel creation. {reason}')
+            logger.warning('Server rejected tunnel creation. %s', reason)
             logger.info('Waiting for 1 minute before re-trying...')
             time.sleep(60)
             continue
@@ -94,7 +101,12 @@ def main():
             break
 
         logger.info('Tunnel is not created yet...')
-        time.sleep(1)
+
+        # the api should have held on to the request for a while; in
+        # case it didn't, don't hammer it.
+        elapsed = time.monotonic() - start_time
+        if elapsed < 1:
+            time.sleep(1 - elapsed)
 
     logger.info('Tunnel is ready.')
 
@@ -134,7 +146,7 @@ def main():
         try:
             session.get(f'{api_hostname}/connect/tunnel')
         except requests.RequestException as e:
-            logger.warning('Error while sending heartbeat: {e}')
+            logger.warning('Error while sending heartbeat: %s', e)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,242 @@
+import time
+import random
+import logging
+import threading
+import requests
+from collections import defaultdict
+from functools import partial
+from CloudFlare.exceptions import CloudFlareAPIError
+from pyutils import env, defenv
+from . import metrics
+
+# Cloudflare allows 1200 API calls per 5 minutes per user, that is 4
+# per second on average.
+defenv('CLOUDFLARE_API_RATE', float, default=4.0)
+defenv('CLOUDFLARE_API_BURST', int, default=20)
+defenv('CLOUDFLARE_API_MAX_RETRIES', int, default=5)
+defenv('CLOUDFLARE_API_THROTTLE_PENALTY', float, default=10.0)
+
+logger = logging.getLogger(__name__)
+
+HTTP_METHODS = {'get', 'post', 'put', 'patch', 'delete'}
+IDEMPOTENT_METHODS = {'get', 'put', 'delete'}
+
+# error codes Cloudflare uses when it's throttling us
+THROTTLE_ERROR_CODES = {429, 971, 10013}
+
+BUCKET_KEY = 'connect:cf:rate-limit'
+
+# A token bucket shared by everyone using the same redis key. Every call
+# takes a token, even when there are none left: the bucket goes
+# negative and the caller is told how many milliseconds to wait for its
+# turn, so waiting callers are served in order. With ARGV[3] set, the
+# bucket is instead emptied for that many milliseconds (after a
+# throttled call).
+BUCKET_SCRIPT = '''
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local penalty = tonumber(ARGV[3])
+local time = redis.call('TIME')
+local now = tonumber(time[1]) * 1000 + math.floor(tonumber(time[2]) / 1000)
+
+local data = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(data[1]) or burst
+local ts = tonumber(data[2]) or now
+tokens = math.min(burst, tokens + (now - ts) / 1000 * rate)
+
+if penalty > 0 then
+    tokens = math.min(tokens, -penalty / 1000 * rate)
+else
+    tokens = tokens - 1
+end
+
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'ts', now)
+redis.call('PEXPIRE', KEYS[1], math.ceil(burst / rate * 1000) + 60000)
+if tokens >= 0 then
+    return 0
+end
+return math.ceil(-tokens / rate * 1000)
+'''
+
+
+class TokenBucket:
+    # Client-side rate limiting, shared by all worker threads and
+    # replicas through redis.
+
+    def __init__(self, redis, rate=None, burst=None, key=BUCKET_KEY):
+        self.rate = rate or env.CLOUDFLARE_API_RATE
+        self.burst = burst or env.CLOUDFLARE_API_BURST
+        self.key = key
+        self._script = redis.register_script(BUCKET_SCRIPT)
+
+    def acquire(self):
+        # Blocks until we're allowed to make a call. Returns the time
+        # spent waiting, in seconds.
+        wait_ms = self._script(keys=[self.key],
+                               args=[self.rate, self.burst, 0])
+        if wait_ms:
+            time.sleep(wait_ms / 1000)
+        return wait_ms / 1000
+
+    def penalize(self, seconds):
+        # Stop everyone from making calls for the given time.
+        self._script(keys=[self.key],
+                     args=[self.rate, self.burst, int(seconds * 1000)])
+
+
+class ApiStats:
+    COUNTERS = ('calls', 'throttles', 'retries', 'errors')
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = defaultdict(lambda: dict.fromkeys(self.COUNTERS, 0))
+        self._wait_time = 0.0
+
+    def incr(self, endpoint, counter):
+        with self._lock:
+            self._counters[endpoint][counter] += 1
+        metrics.cf_api_events.labels(endpoint, counter).inc()
+
+    def add_wait_time(self, seconds):
+        with self._lock:
+            self._wait_time += seconds
+        metrics.cf_api_wait_seconds.inc(seconds)
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'endpoints': {
+                    endpoint: dict(counters)
+                    for endpoint, counters in self._counters.items()
+                },
+                'wait_time': self._wait_time,
+            }
+
+    def log(self):
+        snapshot = self.snapshot()
+        for endpoint, counters in sorted(snapshot['endpoints'].items()):
+            counters = ' '.join(f'{k}={v}' for k, v in counters.items())
+            logger.info('cf api %s: %s', endpoint, counters)
+        logger.info('cf api rate limit wait time: %.1fs',
+                    snapshot['wait_time'])
+
+
+class RateLimitedCloudFlare:
+    # Wraps a CloudFlare object, so that every API call made through
+    # it (like cf.zones.dns_records.get(...)) waits for the shared
+    # token bucket, is counted, and is retried with jittered
+    # exponential backoff if it's throttled or fails in a way that's
+    # safe to retry.
+
+    def __init__(self, cf, bucket=None, stats=None, max_retries=None):
+        self.cf = cf
+        self.bucket = bucket
+        self.stats = stats if stats is not None else ApiStats()
+        self.max_retries = max_retries
+        if self.max_retries is None:
+            self.max_retries = env.CLOUDFLARE_API_MAX_RETRIES
+
+    def __getattr__(self, name):
+        return _Endpoint(self, getattr(self.cf, name), name)
+
+    def call(self, endpoint, method, func, *args, **kwargs):
+        endpoint = f'{endpoint}.{method}'
+        with metrics.cf_api_seconds.labels(endpoint).time():
+            return self._call(endpoint, method, func, *args, **kwargs)
+
+    def _call(self, endpoint, method, func, *args, **kwargs):
+        attempt = 0
+        while True:
+            if self.bucket is not None:
+                self.stats.add_wait_time(self.bucket.acquire())
+            self.stats.incr(endpoint, 'calls')
+            try:
+                return func(*args, **kwargs)
+            except (requests.RequestException, CloudFlareAPIError) as e:
+                throttled = is_throttled(e)
+                if throttled:
+                    self.stats.incr(endpoint, 'throttles')
+                    hint = get_retry_after(e)
+                    if hint is None:
+                        hint = env.CLOUDFLARE_API_THROTTLE_PENALTY
+                    if self.bucket is not None:
+                        self.bucket.penalize(hint)
+                elif not (method in IDEMPOTENT_METHODS and
+                          is_transient(e)):
+                    self.stats.incr(endpoint, 'errors')
+                    raise
+                else:
+                    hint = None
+
+                if attempt >= self.max_retries:
+                    self.stats.incr(endpoint, 'errors')
+                    logger.error('Not retrying %s anymore: %s', endpoint, e)
+                    raise
+
+            attempt += 1
+            wait_time = backoff(attempt, hint)
+            self.stats.incr(endpoint, 'retries')
+            if throttled:
+                logger.warning('Throttled on %s; retrying in %.1fs...',
+                               endpoint, wait_time)
+            else:
+                logger.warning('Error calling %s; retrying in %.1fs...',
+                               endpoint, wait_time)
+            time.sleep(wait_time)
+
+
+class _Endpoint:
+    def __init__(self, client, target, path):
+        self._client = client
+        self._target = target
+        self._path = path
+
+    def __getattr__(self, name):
+        attr = getattr(self._target, name)
+        if name in HTTP_METHODS:
+            return partial(self._client.call, self._path, name, attr)
+        return _Endpoint(self._client, attr, f'{self._path}.{name}')
+
+
+def backoff(attempt, hint=None, base=0.5, cap=30.0):
+    # "full jitter" exponential backoff. A server hint is a lower bound;
+    # with the bucket penalized for that long, the other callers are
+    # held back as well, so a little jitter on top spreads them out.
+    wait_time = random.uniform(0, min(cap, base * 2 ** attempt))
+    if hint is not None:
+        wait_time += hint
+    return wait_time
+
+
+def is_throttled(e):
+    if isinstance(e, requests.HTTPError) and e.response is not None:
+        return e.response.status_code == 429
+    if isinstance(e, CloudFlareAPIError):
+        return int(e) in THROTTLE_ERROR_CODES or \
+            'rate limit' in str(e).lower()
+    return False
+
+
+def is_transient(e):
+    if isinstance(e, CloudFlareAPIError):
+        # the library raises every requests exception (connection
+        # errors, timeouts) as code 0. without a json body, the error
+        # code is the http status.
+        return int(e) == 0 or 500 <= int(e) < 600
+    if isinstance(e, requests.HTTPError) and e.response is not None:
+        return e.response.status_code >= 500
+    return isinstance(e, requests.RequestException)
+
+
+def get_retry_after(e):
+    # The CloudFlare library does not expose response headers, so a
+    # Retry-After hint is only available for errors raised by requests
+    # itself.
+    response = getattr(e, 'response', None)
+    if response is None:
+        return None
+    value = response.headers.get('Retry-After')
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
@@ -0,0 +1,184 @@
+# An in-process stand-in for the parts of the Cloudflare API that
+# connect.worker uses (tunnels, tunnel configurations and DNS records),
+# for measuring the worker without touching a real account. Latency,
+# connection errors and throttling can be injected.
+#
+# Usage:
+#
+#     fake = FakeCloudflare(latency=0.1, throttle_rate=0.01)
+#     worker.cf_factory = fake.client
+
+import time
+import random
+import threading
+from uuid import uuid4
+from datetime import datetime, timezone
+from collections import Counter
+from CloudFlare.exceptions import CloudFlareAPIError
+
+
+class FakeCloudflare:
+    def __init__(self, latency=0.0, latency_jitter=0.0, error_rate=0.0,
+                 throttle_rate=0.0, seed=None):
+        self.latency = latency
+        self.latency_jitter = latency_jitter
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.tunnels = {}
+        self.configurations = {}
+        self.dns_records = {}
+        self.calls = Counter()
+        self.injected = Counter()
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def client(self):
+        # Returns an object shaped like a CloudFlare instance. All
+        # clients share this fake's state.
+        return _Node(self, '')
+
+    def request(self, endpoint):
+        # Called at the start of every API call; simulates the round
+        # trip and raises injected errors.
+        with self._lock:
+            self.calls[endpoint] += 1
+            roll = self._random.random()
+            delay = self.latency + self._random.uniform(
+                0, self.latency_jitter)
+        time.sleep(delay)
+
+        if roll < self.throttle_rate:
+            with self._lock:
+                self.injected['throttles'] += 1
+            raise CloudFlareAPIError(
+                971, 'Please wait and consider throttling your request speed')
+        if roll < self.throttle_rate + self.error_rate:
+            with self._lock:
+                self.injected['errors'] += 1
+            # the real client raises requests exceptions like this.
+            raise CloudFlareAPIError(0, 'connection error')
+
+    def total_calls(self):
+        with self._lock:
+            return sum(self.calls.values())
+
+    # accounts.cfd_tunnel
+
+    def get_tunnels(self, account_id, params=None):
+        self.request('accounts.cfd_tunnel.get')
+        with self._lock:
+            tunnels = list(self.tunnels.values())
+        return paginate(tunnels, params)
+
+    def post_tunnel(self, account_id, data=None):
+        self.request('accounts.cfd_tunnel.post')
+        with self._lock:
+            for tunnel in self.tunnels.values():
+                if tunnel['name'] == data['name']:
+                    raise CloudFlareAPIError(
+                        1013, 'You already have a tunnel with this name')
+            tunnel = {
+                'id': str(uuid4()),
+                'name': data['name'],
+                'created_at': now(),
+                'deleted_at': None,
+                'connections': [],
+            }
+            self.tunnels[tunnel['id']] = tunnel
+        return dict(tunnel)
+
+    def delete_tunnel(self, account_id, tunnel_id):
+        self.request('accounts.cfd_tunnel.delete')
+        with self._lock:
+            if self.tunnels.pop(tunnel_id, None) is None:
+                raise CloudFlareAPIError(1003, 'Tunnel not found')
+            self.configurations.pop(tunnel_id, None)
+        return {'id': tunnel_id}
+
+    # accounts.cfd_tunnel.configurations
+
+    def put_configuration(self, account_id, tunnel_id, data=None):
+        self.request('accounts.cfd_tunnel.configurations.put')
+        with self._lock:
+            if tunnel_id not in self.tunnels:
+                raise CloudFlareAPIError(1003, 'Tunnel not found')
+            self.configurations[tunnel_id] = data['config']
+        return {'tunnel_id': tunnel_id, 'config': data['config']}
+
+    # zones.dns_records
+
+    def get_dns_records(self, zone_id, params=None):
+        self.request('zones.dns_records.get')
+        with self._lock:
+            records = list(self.dns_records.values())
+        record_type = (params or {}).get('type')
+        if record_type:
+            records = [r for r in records if r['type'] == record_type]
+        return paginate(records, params)
+
+    def post_dns_record(self, zone_id, data=None):
+        self.request('zones.dns_records.post')
+        with self._lock:
+            for record in self.dns_records.values():
+                if record['name'] == data['name']:
+                    raise CloudFlareAPIError(
+                        81053, 'An A, AAAA, or CNAME record with that '
+                        'host already exists.')
+            record = dict(data, id=uuid4().hex, created_on=now())
+            self.dns_records[record['id']] = record
+        return dict(record)
+
+    def delete_dns_record(self, zone_id, record_id):
+        self.request('zones.dns_records.delete')
+        with self._lock:
+            if self.dns_records.pop(record_id, None) is None:
+                raise CloudFlareAPIError(81044, 'Record does not exist.')
+        return {'id': record_id}
+
+
+# maps the attribute path of each end-point on a CloudFlare object to
+# the fake's implementation of its methods.
+ENDPOINTS = {
+    'accounts.cfd_tunnel': {
+        'get': 'get_tunnels',
+        'post': 'post_tunnel',
+        'delete': 'delete_tunnel',
+    },
+    'accounts.cfd_tunnel.configurations': {
+        'put': 'put_configuration',
+    },
+    'zones.dns_records': {
+        'get': 'get_dns_records',
+        'post': 'post_dns_record',
+        'delete': 'delete_dns_record',
+    },
+}
+
+
+class _Node:
+    def __init__(self, fake, path):
+        self._fake = fake
+        self._path = path
+
+    def __getattr__(self, name):
+        methods = ENDPOINTS.get(self._path, {})
+        if name in methods:
+            return getattr(self._fake, methods[name])
+        path = f'{self._path}.{name}' if self._path else name
+        return _Node(self._fake, path)
+
+
+def paginate(items, params):
+    params = params or {}
+    if 'is_deleted' in params:
+        items = [i for i in items if i.get('deleted_at') is None]
+    if 'name' in params:
+        items = [i for i in items if i['name'] == params['name']]
+    page = int(params.get('page', 1))
+    per_page = int(params.get('per_page', 20))
+    start = (page - 1) * per_page
+    return [dict(i) for i in items[start:start + per_page]]
+
+
+def now():
+    return datetime.now(timezone.utc).isoformat().replace('+00:00', 'Z')
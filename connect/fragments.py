@@ -0,0 +1,49 @@
+import re
+from uuid import uuid4
+from markupsafe import escape
+
+
+class CompiledTemplate:
+    # A template rendered once, and split into its static parts (as
+    # bytes) and the names of the values that go between them. Filling
+    # it in is a single join, with no template rendering involved.
+
+    def __init__(self, fragments, slots, html=False):
+        self.fragments = fragments
+        self.slots = slots
+        self.html = html
+
+    def render(self, **values):
+        if self.html:
+            values = {name: escape(value) for name, value in values.items()}
+        values = {
+            name: str(value).encode('utf-8')
+            for name, value in values.items()
+        }
+        parts = [self.fragments[0]]
+        for slot, fragment in zip(self.slots, self.fragments[1:]):
+            parts.append(values[slot])
+            parts.append(fragment)
+        return b''.join(parts)
+
+
+def compile_template(render, slots, html=False):
+    # `render` is called once with a unique marker for each of the
+    # given slots, and should return the rendered template as a string.
+    # The markers are chosen so that html escaping leaves them alone;
+    # with html=True, the values are escaped when they're filled in
+    # instead.
+    markers = {slot: f'__{slot}_{uuid4().hex}__' for slot in slots}
+    text = render(**markers)
+
+    slot_names = {marker: slot for slot, marker in markers.items()}
+    pattern = re.compile('|'.join(re.escape(m) for m in slot_names))
+    fragments = []
+    found = []
+    pos = 0
+    for match in pattern.finditer(text):
+        fragments.append(text[pos:match.start()].encode('utf-8'))
+        found.append(slot_names[match.group()])
+        pos = match.end()
+    fragments.append(text[pos:].encode('utf-8'))
+    return CompiledTemplate(fragments, found, html=html)
@@ -0,0 +1,198 @@
+import json
+import time
+from datetime import datetime
+from pyutils import env, defenv
+
+defenv('CONNECT_INVENTORY_SYNC_INTERVAL', int, default=600)
+
+TUNNELS_KEY = 'connect:cf:tunnels'
+DNS_RECORDS_KEY = 'connect:cf:dns-records'
+SYNCED_AT_KEY = 'connect:cf:synced-at'
+DRIFT_KEY = 'connect:cf:drift'
+RESERVATIONS_KEY = 'connect:cf:reservations'
+
+CF_TUNNEL_DOMAIN = '.cfargotunnel.com'
+
+# Reserves up to ARGV[2] tunnel slots for worker ARGV[1], out of a
+# total of ARGV[3], taking into account the existing tunnels and the
+# reservations of other workers. Reservations are stored as
+# "count:expiry_ms", and expired ones (of crashed workers) are ignored
+# and cleaned up. Returns the number of slots granted.
+RESERVE_SCRIPT = '''
+local now = tonumber(ARGV[4])
+local reserved = 0
+local entries = redis.call('HGETALL', KEYS[2])
+for i = 1, #entries, 2 do
+    if entries[i] ~= ARGV[1] then
+        local count, expiry = string.match(entries[i + 1], '(%d+):(%d+)')
+        if tonumber(expiry) > now then
+            reserved = reserved + tonumber(count)
+        else
+            redis.call('HDEL', KEYS[2], entries[i])
+        end
+    end
+end
+
+local free = tonumber(ARGV[3]) - redis.call('HLEN', KEYS[1]) - reserved
+local granted = math.max(0, math.min(free, tonumber(ARGV[2])))
+redis.call('HSET', KEYS[2], ARGV[1],
+           granted .. ':' .. (now + tonumber(ARGV[5])))
+return granted
+'''
+
+# Replaces the inventory (KEYS[1] and KEYS[2]) with the listing in
+# ARGV[3] and ARGV[4] (json objects of id -> entry), except for the
+# entries created at or after ARGV[1]: those were added while the
+# listing was under way, so it might have missed them. Clears the drift
+# (KEYS[3]), and sets the sync time (KEYS[4]) to ARGV[2].
+REPLACE_SCRIPT = '''
+local started_at = tonumber(ARGV[1])
+for i, listing in ipairs({ARGV[3], ARGV[4]}) do
+    local entries = redis.call('HGETALL', KEYS[i])
+    redis.call('DEL', KEYS[i])
+    for id, entry in pairs(cjson.decode(listing)) do
+        redis.call('HSET', KEYS[i], id, entry)
+    end
+    for j = 1, #entries, 2 do
+        local created_at = cjson.decode(entries[j + 1])['created_at']
+        if created_at and created_at >= started_at then
+            redis.call('HSET', KEYS[i], entries[j], entries[j + 1])
+        end
+    end
+end
+redis.call('DEL', KEYS[3])
+redis.call('SET', KEYS[4], ARGV[2])
+'''
+
+# worker clocks are not exactly in sync, so entries a little older than
+# the start of a listing are kept as well.
+SYNC_CLOCK_SLACK = 60
+
+
+class CloudflareInventory:
+    # A copy of the Cloudflare tunnels and DNS records that belong to
+    # us, kept in redis. The worker updates it on every create and
+    # delete it does itself, so listing the whole account and zone is
+    # only needed every CONNECT_INVENTORY_SYNC_INTERVAL seconds (to
+    # catch changes made by anyone else), or when something we do
+    # shows that our copy is out of date.
+
+    def __init__(self, redis):
+        self.redis = redis
+        self.sync_interval = env.CONNECT_INVENTORY_SYNC_INTERVAL
+        self._reserve = redis.register_script(RESERVE_SCRIPT)
+        self._replace = redis.register_script(REPLACE_SCRIPT)
+
+    def needs_sync(self):
+        synced_at, drift = self.redis.mget(SYNCED_AT_KEY, DRIFT_KEY)
+        if synced_at is None or drift is not None:
+            return True
+        return time.time() - float(synced_at) >= self.sync_interval
+
+    def mark_drift(self, reason):
+        self.redis.set(DRIFT_KEY, reason)
+
+    def get_drift(self):
+        return self.redis.get(DRIFT_KEY)
+
+    def replace(self, tunnels, dns_records, started_at):
+        # Replace the whole inventory with the result of a full
+        # listing, that started at `started_at`. Only our own tunnels
+        # and DNS records are kept, along with whatever was added (by
+        # any worker) after the listing started.
+        tunnels = {
+            t['id']: json.dumps({
+                'id': t['id'],
+                'name': t['name'],
+                'created_at': parse_timestamp(t.get('created_at')),
+            })
+            for t in tunnels if is_connect_tunnel(t)
+        }
+        dns_records = {
+            r['id']: json.dumps({
+                'id': r['id'],
+                'name': r['name'],
+                'content': r['content'],
+                'created_at': parse_timestamp(r.get('created_on')),
+            })
+            for r in dns_records if is_connect_dns_record(r)
+        }
+        self._replace(
+            keys=[TUNNELS_KEY, DNS_RECORDS_KEY, DRIFT_KEY, SYNCED_AT_KEY],
+            args=[started_at - SYNC_CLOCK_SLACK, time.time(),
+                  json.dumps(tunnels), json.dumps(dns_records)])
+
+    def add_tunnel(self, tunnel_id, name):
+        self.redis.hset(TUNNELS_KEY, tunnel_id, json.dumps({
+            'id': tunnel_id,
+            'name': name,
+            'created_at': time.time(),
+        }))
+
+    def remove_tunnel(self, tunnel_id):
+        self.redis.hdel(TUNNELS_KEY, tunnel_id)
+
+    def get_tunnels(self):
+        return [
+            json.loads(t) for t in self.redis.hvals(TUNNELS_KEY)
+        ]
+
+    def count_tunnels(self):
+        return self.redis.hlen(TUNNELS_KEY)
+
+    def reserve_slots(self, owner, wanted, limit, ttl):
+        # Reserve room for up to `wanted` new tunnels (for at most
+        # `ttl` seconds), so that workers provisioning at the same
+        # time don't go over the limit together.
+        return self._reserve(
+            keys=[TUNNELS_KEY, RESERVATIONS_KEY],
+            args=[owner, wanted, limit, int(time.time() * 1000),
+                  int(ttl * 1000)])
+
+    def release_slots(self, owner):
+        self.redis.hdel(RESERVATIONS_KEY, owner)
+
+    def add_dns_record(self, record_id, name, content):
+        self.redis.hset(DNS_RECORDS_KEY, record_id, json.dumps({
+            'id': record_id,
+            'name': name,
+            'content': content,
+            'created_at': time.time(),
+        }))
+
+    def remove_dns_record(self, record_id):
+        self.redis.hdel(DNS_RECORDS_KEY, record_id)
+
+    def get_dns_records(self):
+        return [
+            json.loads(r) for r in self.redis.hvals(DNS_RECORDS_KEY)
+        ]
+
+
+def is_connect_tunnel(tunnel):
+    prefix = env.get_config().CONNECT_SUBDOMAIN_PREFIX
+    return tunnel['name'].startswith(prefix)
+
+
+def is_connect_dns_record(record):
+    if record['type'] != 'CNAME':
+        return False
+    prefix = env.get_config().CONNECT_SUBDOMAIN_PREFIX
+    if not record['name'].startswith(prefix):
+        return False
+    return record['content'].endswith(CF_TUNNEL_DOMAIN)
+
+
+def parse_timestamp(value):
+    # Cloudflare timestamps look like 2022-11-05T12:34:56.123456Z. An
+    # unknown creation time is treated as the distant past.
+    if not value:
+        return 0
+    try:
+        return datetime.fromisoformat(value.replace('Z', '+00:00')).timestamp()
+    except ValueError:
+        return 0
+
+
+def get_record_tunnel_id(record):
+    return record['content'][:-len(CF_TUNNEL_DOMAIN)]
@@ -0,0 +1,61 @@
+# Redis based leases, used to coordinate multiple connect worker
+# replicas. A lease is a key holding the name of its owner, which
+# expires unless the owner keeps renewing it, so the leases of a
+# crashed worker are freed up automatically.
+
+ACQUIRE_SCRIPT = '''
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('PEXPIRE', KEYS[1], ARGV[2])
+end
+if redis.call('SET', KEYS[1], ARGV[1], 'NX', 'PX', ARGV[2]) then
+    return 1
+end
+return 0
+'''
+
+RELEASE_SCRIPT = '''
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+'''
+
+
+class Lease:
+    def __init__(self, redis, key, owner, ttl):
+        self.redis = redis
+        self.key = key
+        self.owner = owner
+        self.ttl_ms = int(ttl * 1000)
+        self._acquire = redis.register_script(ACQUIRE_SCRIPT)
+        self._release = redis.register_script(RELEASE_SCRIPT)
+
+    def acquire(self):
+        # Acquires the lease if it's free, or renews it if we already
+        # hold it. Returns whether we hold the lease now.
+        return bool(self._acquire(keys=[self.key],
+                                  args=[self.owner, self.ttl_ms]))
+
+    def release(self):
+        self._release(keys=[self.key], args=[self.owner])
+
+
+def acquire_leases(redis, keys, owner, ttl):
+    # Try to acquire a batch of leases in one round trip. Returns a
+    # list of booleans, one for each key. Already held leases are not
+    # renewed, since this is meant for one-off ownership of a piece of
+    # work, rather than something held for long.
+    if not keys:
+        return []
+    pipe = redis.pipeline(transaction=False)
+    for key in keys:
+        pipe.set(key, owner, nx=True, px=int(ttl * 1000))
+    return [bool(acquired) for acquired in pipe.execute()]
+
+
+def release_leases(redis, keys, owner):
+    release = redis.register_script(RELEASE_SCRIPT)
+    pipe = redis.pipeline(transaction=False)
+    for key in keys:
+        release(keys=[key], args=[owner], client=pipe)
+    pipe.execute()
@@ -0,0 +1,86 @@
+# Prometheus metrics for connect.worker. They are served over http by
+# the worker (see CONNECT_METRICS_PORT).
+
+from prometheus_client import Counter, Gauge, Histogram
+
+# the worker's loop phases go from milliseconds (most of them, most of
+# the time) to tens of seconds (provisioning a large batch).
+PHASE_BUCKETS = (
+    .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60,
+)
+
+API_BUCKETS = (.025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30)
+
+loop_phase_seconds = Histogram(
+    'connect_worker_phase_seconds',
+    'Time spent in each phase of the worker loop.',
+    ['phase'], buckets=PHASE_BUCKETS)
+
+tunnel_stage_seconds = Histogram(
+    'connect_worker_tunnel_stage_seconds',
+    'Time spent in each stage of creating a Cloudflare tunnel.',
+    ['stage'], buckets=API_BUCKETS)
+
+cf_api_seconds = Histogram(
+    'connect_worker_cf_api_seconds',
+    'Latency of Cloudflare API calls, including retries.',
+    ['endpoint'], buckets=API_BUCKETS)
+
+cf_api_events = Counter(
+    'connect_worker_cf_api_events',
+    'Cloudflare API calls, throttles, retries and errors.',
+    ['endpoint', 'event'])
+
+cf_api_wait_seconds = Counter(
+    'connect_worker_cf_api_wait_seconds',
+    'Time spent waiting for the client-side Cloudflare rate limit.')
+
+tunnels_provisioned = Counter(
+    'connect_worker_tunnels_provisioned',
+    'Tunnels created, for connectors or for the pool.',
+    ['target'])
+
+tunnels_failed = Counter(
+    'connect_worker_tunnels_failed',
+    'Tunnels that could not be created.')
+
+tunnels_rejected = Counter(
+    'connect_worker_tunnels_rejected',
+    'Connectors rejected because there were no free tunnel slots.')
+
+tunnels_deleted = Counter(
+    'connect_worker_tunnels_deleted',
+    'Orphaned tunnels deleted by garbage collection.')
+
+dns_records_deleted = Counter(
+    'connect_worker_dns_records_deleted',
+    'Orphaned DNS records deleted by garbage collection.')
+
+pending_tunnels = Gauge(
+    'connect_worker_pending_tunnels',
+    'Connectors waiting for a tunnel (queued or being provisioned).')
+
+oldest_pending_seconds = Gauge(
+    'connect_worker_oldest_pending_seconds',
+    'Age of the oldest connector still waiting for a tunnel.')
+
+active_tunnels = Gauge(
+    'connect_worker_active_tunnels',
+    'Tunnel records that have a Cloudflare tunnel.')
+
+orphaned_tunnels = Gauge(
+    'connect_worker_orphaned_tunnels',
+    'Cloudflare tunnels without a tunnel record, as of the last '
+    'garbage collection.')
+
+pooled_tunnels = Gauge(
+    'connect_worker_pooled_tunnels',
+    'Ready-made tunnels in the pool.')
+
+cf_tunnels = Gauge(
+    'connect_worker_cf_tunnels',
+    'Cloudflare tunnels in the inventory.')
+
+is_leader = Gauge(
+    'connect_worker_is_leader',
+    'Whether this worker is the leader.')
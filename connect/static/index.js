@@ -0,0 +1,7 @@
+function copyToClipboard(text) {
+    navigator.clipboard.writeText(text).then();
+}
+function copyCompose() {
+    let el = document.getElementById('docker-compose-code');
+    copyToClipboard(el.innerText);
+}
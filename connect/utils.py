@@ -1,31 +1,126 @@
 import os
 import jwt
+import time
+import logging
+import threading
 import jinja2
 from uuid import uuid4
+from collections import deque
 from base64 import b64encode, b32encode
 from pyutils import env, defenv, get_redis
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 defenv('ONE_VERSION', str, optional=False)
 defenv('CONNECT_SUBDOMAIN_SEED', int, optional=False)
 defenv('CONNECT_SUBDOMAIN_PREFIX', str, default='t-')
+defenv('CONNECT_SUBDOMAIN_BLOCK_SIZE', int, default=100)
+defenv('CONNECT_CREDENTIAL_POOL_SIZE', int, default=1000)
+
+logger = logging.getLogger(__name__)
+
+SUBDOMAIN_IDX_KEY = 'connect:subdomain:idx'
+
+LCG_A = 6364136223846793005
+LCG_C = 1442695040888963407
+LCG_MASK = 2 ** 64 - 1
+
+# batches smaller than this are faster to generate without numpy.
+NUMPY_MIN_BATCH = 1000
+
+if numpy is not None:
+    B32_ALPHABET = numpy.frombuffer(
+        b'abcdefghijklmnopqrstuvwxyz234567', dtype=numpy.uint8)
 
 jinja_env = jinja2.Environment(
     loader=jinja2.FileSystemLoader('connect/templates/'))
 docker_compose_template = jinja_env.get_template('docker-compose.yml')
 
 
-def get_compose_file(redis, secret_key):
-    tunnel_idx = redis.incr('connect:subdomain:idx')
-    subdomain = get_subdomain(tunnel_idx)
-    token = create_tunnel_token(secret_key, subdomain)
-    version = env.ONE_VERSION
-    ss_password = b64encode(os.urandom(9)).decode('ascii')
-    ss_password += '#MahsaAmini'
-    return docker_compose_template.render(
-        token=token,
-        one_version=version,
-        ss_password=ss_password
-    )
+class SubdomainAllocator:
+    # Hands out sub-domains for new tunnels. Instead of an INCR per
+    # sub-domain, indices are reserved from redis a block at a time
+    # with INCRBY, and handed out locally. Every index is used at most
+    # once: indices left in a block when the process exits are simply
+    # skipped, which is fine since the LCG has 2**64 of them.
+
+    def __init__(self, redis, block_size=None):
+        self.redis = redis
+        self.block_size = block_size or env.CONNECT_SUBDOMAIN_BLOCK_SIZE
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        self._pid = os.getpid()
+        self._subdomains = deque()
+
+    def next_subdomain(self):
+        with self._lock:
+            if self._pid != os.getpid():
+                # a forked child must not hand out its parent's block.
+                self._reset()
+            if not self._subdomains:
+                end = self.redis.incrby(SUBDOMAIN_IDX_KEY, self.block_size)
+                self._subdomains.extend(
+                    get_subdomains(end - self.block_size + 1,
+                                   self.block_size))
+            return self._subdomains.popleft()
+
+
+class CredentialPool:
+    # Tokens and shadowsocks passwords for new connectors, minted ahead
+    # of time by a background thread, so that handing one out is just
+    # taking it from a queue. If the pool runs dry, credentials are
+    # minted on the spot.
+
+    def __init__(self, subdomains, secret_key, size=None):
+        # `subdomains` is a SubdomainAllocator.
+        self.subdomains = subdomains
+        self.secret_key = secret_key
+        self.size = size or env.CONNECT_CREDENTIAL_POOL_SIZE
+        self._pid = None
+
+    def start(self):
+        self._pid = os.getpid()
+        self._pool = deque()
+        self._wakeup = threading.Event()
+        self._wakeup.set()
+        threading.Thread(
+            target=self._run, name='credential-pool', daemon=True).start()
+
+    def take(self):
+        # Returns a (token, ss_password) tuple. Every tuple is handed
+        # out only once.
+        if self._pid != os.getpid():
+            # a forked child must not hand out its parent's credentials.
+            self.start()
+        try:
+            credentials = self._pool.popleft()
+        except IndexError:
+            credentials = self.mint()
+        if len(self._pool) < self.size // 2:
+            self._wakeup.set()
+        return credentials
+
+    def mint(self):
+        subdomain = self.subdomains.next_subdomain()
+        token = create_tunnel_token(self.secret_key, subdomain)
+        return token, create_ss_password()
+
+    def _run(self):
+        while True:
+            self._wakeup.wait()
+            self._wakeup.clear()
+            try:
+                while len(self._pool) < self.size:
+                    self._pool.append(self.mint())
+            except Exception:
+                logger.exception('Error minting credentials')
+                time.sleep(1)
+                self._wakeup.set()
 
 
 def create_tunnel_token(secret, tunnel_name):
@@ -39,16 +134,43 @@ def create_tunnel_token(secret, tunnel_name):
     return token
 
 
+def create_ss_password():
+    ss_password = b64encode(os.urandom(9)).decode('ascii')
+    ss_password += '#MahsaAmini'
+    return ss_password
+
+
 def get_subdomain(idx):
     # Return a tunnel deterministically chosen sub-domain for the
     # given index.
-    subdomain = lcg(idx)
-    subdomain = subdomain.to_bytes(length=8, byteorder='big')
+    return format_subdomain(lcg(idx))
+
+
+def get_subdomains(start, count):
+    # Same as [get_subdomain(i) for i in range(start, start + count)],
+    # but the LCG is only skipped ahead once, and then stepped through
+    # the rest of the range. Large batches are generated with numpy,
+    # if it's available.
+    if count <= 0:
+        return []
+    if numpy is not None and count >= NUMPY_MIN_BATCH:
+        return _get_subdomains_numpy(start, count)
+
+    x = lcg(start)
+    subdomains = [format_subdomain(x)]
+    for _ in range(count - 1):
+        x = (LCG_A * x + LCG_C) & LCG_MASK
+        subdomains.append(format_subdomain(x))
+    return subdomains
+
+
+def format_subdomain(x):
+    subdomain = x.to_bytes(length=8, byteorder='big')
     subdomain = b32encode(subdomain)
     subdomain = subdomain.decode('ascii')
     subdomain = subdomain.strip('=')
     subdomain = subdomain.lower()
-    subdomain = env.CONNECT_SUBDOMAIN_PREFIX + subdomain
+    subdomain = env.get_config().CONNECT_SUBDOMAIN_PREFIX + subdomain
     return subdomain
 
 
@@ -63,13 +185,57 @@ def lcg(n):
     # With a known seed value, this function generates a deterministic
     # sequence.
     #
-    # The closed form of the LCG formula is taken from this article:
+    # x(n) = a**n * x0 + c * (a**(n-1) + ... + a + 1), and both terms
+    # are computed modulo 2**64 by repeated squaring, so this takes
+    # O(log n) steps on numbers that never get much bigger than 128
+    # bits. See:
     # https://www.nayuki.io/page/fast-skipping-in-a-linear-congruential-generator
     #
     # Also see: https://en.wikipedia.org/wiki/Linear_congruential_generator
 
-    a = 6364136223846793005
-    c = 1442695040888963407
-    m = 2 ** 64
-    x0 = env.CONNECT_SUBDOMAIN_SEED
-    return (((a**n * x0) % m) + ((a**n - 1) % ((a - 1) * m)) // (a - 1) * c) % m
+    mult, plus = get_lcg_skip(n)
+    x0 = env.get_config().CONNECT_SUBDOMAIN_SEED & LCG_MASK
+    return (mult * x0 + plus) & LCG_MASK
+
+
+def get_lcg_skip(n):
+    # Returns (mult, plus) so that stepping the LCG n times from x is
+    # the same as computing (mult * x + plus) % 2**64.
+    mult, plus = 1, 0
+    step_mult, step_plus = LCG_A, LCG_C
+    while n > 0:
+        if n & 1:
+            mult = (mult * step_mult) & LCG_MASK
+            plus = (plus * step_mult + step_plus) & LCG_MASK
+        step_plus = ((step_mult + 1) * step_plus) & LCG_MASK
+        step_mult = (step_mult * step_mult) & LCG_MASK
+        n >>= 1
+    return mult, plus
+
+
+def _get_subdomains_numpy(start, count):
+    # uint64 arithmetic wraps around, so it's already modulo 2**64.
+    # The batch is built by doubling: with the first k values known,
+    # the next k are each k steps ahead of them.
+    values = numpy.array([lcg(start)], dtype=numpy.uint64)
+    while len(values) < count:
+        mult, plus = get_lcg_skip(len(values))
+        values = numpy.concatenate((
+            values,
+            values * numpy.uint64(mult) + numpy.uint64(plus),
+        ))
+    values = values[:count]
+
+    # base32 of the 8 big-endian bytes: 12 characters of 5 bits each,
+    # and a 13th with the last 4 bits and a zero bit of padding.
+    chars = numpy.empty((count, 13), dtype=numpy.uint8)
+    for i in range(12):
+        chars[:, i] = (values >> numpy.uint64(59 - 5 * i)) & numpy.uint64(31)
+    chars[:, 12] = (values & numpy.uint64(15)) << numpy.uint64(1)
+    chars = B32_ALPHABET[chars]
+
+    prefix = env.get_config().CONNECT_SUBDOMAIN_PREFIX
+    return [
+        prefix + subdomain.decode('ascii')
+        for subdomain in chars.view('S13').ravel()
+    ]
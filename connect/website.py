@@ -1,44 +1,83 @@
+import os
 from flask import (
     Blueprint, Flask, render_template, current_app as app, request,
     Response,
 )
 from pyutils import env, defenv, get_redis
+from pyutils.staticfiles import StaticAssets
 from . import utils
+from .fragments import compile_template
 
 defenv('WEBSITE_SECRET_KEY', str, optional=False)
 
 bp = Blueprint('connect-website', __name__, url_prefix='/')
 
+# the pages contain a token that's only meant for whoever asked for it,
+# so nothing in between should keep a copy.
+PERSONAL = 'no-store'
+
+CREDENTIAL_SLOTS = ('token', 'ss_password')
+
 
 def create_app():
-    app = Flask(__name__)
+    env.get_config()
+
+    app = Flask(__name__, static_folder=None)
     app.secret_key = env.WEBSITE_SECRET_KEY
     app.register_blueprint(bp)
 
+    app.assets = StaticAssets(os.path.join(app.root_path, 'static'))
+    app.assets.init_app(app)
+
     app.redis = get_redis()
+    app.subdomains = utils.SubdomainAllocator(app.redis)
+    app.credentials = utils.CredentialPool(app.subdomains, app.secret_key)
+    app.credentials.start()
+
+    # everything but the token and the password is the same for
+    # everyone, so the pages are only rendered once.
+    with app.app_context():
+        app.compose_file = compile_template(
+            render_compose_file, CREDENTIAL_SLOTS)
+        app.home_page = compile_template(
+            lambda **kwargs: render_template(
+                'index.html',
+                docker_compose_code=render_compose_file(**kwargs),
+            ),
+            CREDENTIAL_SLOTS, html=True)
 
     return app
 
 
+def render_compose_file(token, ss_password):
+    return utils.docker_compose_template.render(
+        token=token,
+        one_version=env.ONE_VERSION,
+        ss_password=ss_password,
+    )
+
+
 @bp.get('/')
 def home_page():
-    compose_code = utils.get_compose_file(app.redis, app.secret_key)
-    return render_template(
-        'index.html',
-        docker_compose_code=compose_code,
+    token, ss_password = app.credentials.take()
+    return Response(
+        app.home_page.render(token=token, ss_password=ss_password),
+        mimetype='text/html',
+        headers={'Cache-Control': PERSONAL},
     )
 
 
 @bp.get('/docker-compose.yml')
 def get_docker_compose_file():
-    compose_file = utils.get_compose_file(app.redis, app.secret_key)
+    token, ss_password = app.credentials.take()
+    compose_file = app.compose_file.render(
+        token=token, ss_password=ss_password)
     download = request.args.get('dl', 'false')
     download = download.lower() in ['true', 't', 'yes', 'y']
-    headers = {}
+    headers = {'Cache-Control': PERSONAL}
     if download:
-        headers = {
-            'Content-Disposition': 'attachment: filename=docker-compose.yml',
-        }
+        headers['Content-Disposition'] = \
+            'attachment: filename=docker-compose.yml'
     return Response(
         compose_file,
         mimetype='text/x-yaml',
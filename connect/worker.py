@@ -1,15 +1,25 @@
 import os
-import json
 import time
 import signal
+import socket
 import logging
+import threading
 import requests
-from functools import wraps
-from base64 import b64encode
+from contextlib import contextmanager
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from base64 import b64encode, b32encode
 from CloudFlare import CloudFlare
 from CloudFlare.exceptions import CloudFlareAPIError
+from prometheus_client import start_http_server
 from pyutils import env, defenv, get_redis, config_logging
 from api.tunnel import TunnelManager
+from .inventory import (
+    CloudflareInventory, CF_TUNNEL_DOMAIN, get_record_tunnel_id,
+)
+from .leases import Lease, acquire_leases, release_leases
+from .cfclient import RateLimitedCloudFlare, TokenBucket, ApiStats
+from . import metrics
 
 
 defenv('CLOUDFLARE_ACCOUNT_ID', str, optional=False)
@@ -17,6 +27,21 @@ defenv('CLOUDFLARE_ZONE_ID', str, optional=False)
 defenv('MAX_CF_TUNNELS', int, default=500)
 defenv('CONNECT_DOMAIN', str, optional=False)
 defenv('CONNECT_SUBDOMAIN_PREFIX', str, default='t-')
+defenv('CONNECT_WORKER_NAME', str, default=socket.gethostname())
+defenv('CONNECT_PROVISION_CONCURRENCY', int, default=16)
+defenv('CONNECT_TUNNEL_POOL_SIZE', int, default=10)
+defenv('CONNECT_LEADER_LEASE_TTL', int, default=15)
+defenv('CONNECT_PROVISION_LEASE_TTL', int, default=120)
+# failed tunnel creations are retried after this many seconds, doubled
+# for every failure in a row, up to CONNECT_PROVISION_RETRY_MAX_DELAY.
+defenv('CONNECT_PROVISION_RETRY_DELAY', float, default=2.0)
+defenv('CONNECT_PROVISION_RETRY_MAX_DELAY', float, default=60.0)
+defenv('CONNECT_GC_GRACE_PERIOD', int, default=300)
+defenv('CONNECT_METRICS_PORT', int, default=9100)
+defenv('CONNECT_METRICS_INTERVAL', float, default=5.0)
+
+# the error code for creating a tunnel with a name that is taken
+TUNNEL_NAME_TAKEN = 1013
 
 keep_running = True
 logger = logging.getLogger()
@@ -25,9 +50,26 @@ account_id = env.CLOUDFLARE_ACCOUNT_ID
 zone_id = env.CLOUDFLARE_ZONE_ID
 max_tunnels = env.MAX_CF_TUNNELS
 domain = env.CONNECT_DOMAIN
+pool_size = min(env.CONNECT_TUNNEL_POOL_SIZE, max_tunnels)
+worker_name = env.CONNECT_WORKER_NAME
 
-cf = None
+redis = None
 tunnel_mng = None
+inventory = None
+provision_pool = None
+cf_bucket = None
+cf_stats = ApiStats()
+
+# what get_cf wraps; replaced by the fake in connect.fakecf for load
+# tests.
+cf_factory = CloudFlare
+
+# CloudFlare clients are not shared between threads. Each thread keeps
+# its own, so that the http connections under it are kept alive from
+# one tunnel to the next. The rate limit and the stats are shared by
+# all of them.
+_thread_local = threading.local()
+
 
 def signal_handler(signum, _):
     global keep_running
@@ -37,53 +79,62 @@ def signal_handler(signum, _):
     signal.signal(signal.SIGTERM, signal.SIG_DFL)
 
 
-def create_tunnel(connector_id, tunnel_name):
+def get_cf():
+    cf = getattr(_thread_local, 'cf', None)
+    if cf is None:
+        cf = _thread_local.cf = RateLimitedCloudFlare(
+            cf_factory(), bucket=cf_bucket, stats=cf_stats)
+    return cf
+
+
+@contextmanager
+def timed(timings, stage):
+    start = time.monotonic()
+    try:
+        yield
+    finally:
+        timings[stage] = time.monotonic() - start
+
+
+def create_tunnel(tunnel_name):
+    # Returns the tunnel details (hostname, path and cfd_creds) along
+    # with the time spent in each stage of the creation, in seconds.
+    cf = get_cf()
+    timings = {}
+
     logger.info('Creating Cloudflare tunnel...')
     tunnel_secret = b64encode(os.urandom(32)).decode('ascii')
-    tunnel = cf.accounts.cfd_tunnel.post(
-        account_id,
-        data={'name': tunnel_name, 'tunnel_secret': tunnel_secret}
-    )
+    try:
+        with timed(timings, 'tunnel'):
+            tunnel = cf.accounts.cfd_tunnel.post(
+                account_id,
+                data={'name': tunnel_name, 'tunnel_secret': tunnel_secret}
+            )
+    except CloudFlareAPIError as e:
+        if int(e) == TUNNEL_NAME_TAKEN:
+            # left over from an earlier attempt that failed half-way
+            # (or whose create went through despite an error); out of
+            # the way for the retry.
+            for cf_tunnel in cf.accounts.cfd_tunnel.get(
+                    account_id,
+                    params={'name': tunnel_name, 'is_deleted': 'false'}):
+                delete_half_created_tunnel(
+                    cf_tunnel['id'], f'{tunnel_name}.{domain}')
+        raise
 
     tunnel_id = tunnel['id']
-    logger.info(
-        f'Created Cloudflare tunnel: {tunnel_name} ({tunnel_id})')
+    inventory.add_tunnel(tunnel_id, tunnel_name)
+    logger.info('Created Cloudflare tunnel: %s (%s)', tunnel_name, tunnel_id)
 
-    logger.info('Configuring Cloudflare tunnel...')
     hostname = f'{tunnel_name}.{domain}'
     path = 'graphql'  # just a random end-point for v2ray
-    cf.accounts.cfd_tunnel.configurations.put(
-        account_id, tunnel_id,
-        data={
-            'config': {
-                'ingress': [
-                    {
-                        'hostname': hostname,
-                        'path': path,
-                        'service': 'http://ssv2ray',
-                    },
-                    {
-                        'service': 'http_status:404'
-                    },
-                ],
-            },
-        },
-    )
-    logger.info('Cloudflare tunnel configured.')
-
-    logger.info('Adding DNS record...')
-    cf.zones.dns_records.post(
-        zone_id,
-        data={
-            'type': 'CNAME',
-            'name': hostname,
-            'content': f'{tunnel_id}.cfargotunnel.com',
-            'ttl': 1,  # 1 = automatic
-            'proxied': True,
-        }
-    )
-    logger.info('DNS record created.')
-
+    try:
+        configure_tunnel(cf, timings, tunnel_id, hostname, path)
+    except Exception:
+        # a retry gets the same name, which would be taken for as long
+        # as the half-created tunnel is around.
+        delete_half_created_tunnel(tunnel_id, hostname)
+        raise
     logger.info('Tunnel created.')
 
     cfd_creds = {
@@ -91,135 +142,236 @@ def create_tunnel(connector_id, tunnel_name):
         'TunnelID': tunnel_id,
         'TunnelSecret': tunnel_secret,
     }
-    tunnel_mng.write_tunnel(
-        connector_id,
-        tunnel_name,
-        hostname=hostname,
-        path=path,
-        cfd_creds=cfd_creds,
-        status='ready',
-    )
+    tunnel = {
+        'hostname': hostname,
+        'path': path,
+        'cfd_creds': cfd_creds,
+    }
+    return tunnel, timings
+
 
+def configure_tunnel(cf, timings, tunnel_id, hostname, path):
+    # Sets up the ingress rules and the DNS record of a new tunnel.
+    logger.info('Configuring Cloudflare tunnel...')
+    with timed(timings, 'config'):
+        cf.accounts.cfd_tunnel.configurations.put(
+            account_id, tunnel_id,
+            data={
+                'config': {
+                    'ingress': [
+                        {
+                            'hostname': hostname,
+                            'path': path,
+                            'service': 'http://ssv2ray',
+                        },
+                        {
+                            'service': 'http_status:404'
+                        },
+                    ],
+                },
+            },
+        )
+    logger.info('Cloudflare tunnel configured.')
 
-def retry(f):
-    @wraps(f)
-    def wrapper(*args, **kwargs):
-        retries = 5
-        wait_time = 1
+    logger.info('Adding DNS record...')
+    with timed(timings, 'dns'):
+        dns_record = cf.zones.dns_records.post(
+            zone_id,
+            data={
+                'type': 'CNAME',
+                'name': hostname,
+                'content': f'{tunnel_id}{CF_TUNNEL_DOMAIN}',
+                'ttl': 1,  # 1 = automatic
+                'proxied': True,
+            }
+        )
+    inventory.add_dns_record(
+        dns_record['id'], dns_record['name'], dns_record['content'])
+    logger.info('DNS record created.')
 
-        while True:
-            try:
-                return f(*args, **kwargs)
-            except (requests.RequestException, CloudFlareAPIError) as e:
-                logger.warning(f'Request error while performing cf API call: {e}')
-                if retries == 0:
-                    logger.error('Not retrying anymore.')
-                    raise
 
-            logger.info(f'Retrying after {wait_time} second(s)...')
-            time.sleep(wait_time)
-            wait_time *= 2
-            retries -= 1
+def delete_half_created_tunnel(tunnel_id, hostname):
+    # Best effort: whatever can't be deleted now is left to the garbage
+    # collection.
+    logger.info('Deleting half-created tunnel: %s', tunnel_id)
+    try:
+        # a failed create might have gone through anyway, so the DNS
+        # record is looked up by name.
+        for dns_record in get_cf().zones.dns_records.get(
+                zone_id, params={'type': 'CNAME', 'name': hostname}):
+            delete_dns_record(zone_id, dns_record['id'])
+            inventory.remove_dns_record(dns_record['id'])
+        delete_cf_tunnel(tunnel_id)
+        inventory.remove_tunnel(tunnel_id)
+    except (requests.RequestException, CloudFlareAPIError) as e:
+        logger.warning('Could not delete half-created tunnel %s: %s',
+                       tunnel_id, e)
+
+
+def get_pool_tunnel_name():
+    # Pooled tunnels are created before we know which connector will
+    # get them, so they get a random name of the same shape as the
+    # ones from connect.utils.get_subdomain.
+    name = b32encode(os.urandom(8)).decode('ascii').strip('=').lower()
+    return env.get_config().CONNECT_SUBDOMAIN_PREFIX + name
+
+
+def provision_tunnel(connector_id, tunnel_name):
+    # Creates a tunnel for the given connector, or a tunnel for the
+    # pool if connector_id is None.
+    tunnel, timings = create_tunnel(tunnel_name)
+    if connector_id is None:
+        tunnel_mng.add_pooled_tunnel(**tunnel)
+    else:
+        tunnel_mng.write_tunnel(
+            connector_id, tunnel_name, status='ready', **tunnel)
+    return timings
+
+
+def get_provision_lease_key(connector_id):
+    return f'connect:provisioning:{connector_id}'
+
+
+def provision_tunnels(jobs):
+    # Create tunnels for the given (entry_id, connector_id,
+    # tunnel_name) tuples in parallel, at most
+    # CONNECT_PROVISION_CONCURRENCY at a time. Queue entries are
+    # acknowledged as soon as their tunnel is ready; failed ones are
+    # queued again after a backoff. Jobs for the tunnel pool have
+    # neither an entry_id nor a connector_id.
+    if not jobs:
+        return
+
+    start = time.monotonic()
+    futures = {
+        provision_pool.submit(provision_tunnel, connector_id, tunnel_name):
+        (entry_id, connector_id)
+        for entry_id, connector_id, tunnel_name in jobs
+    }
+
+    stage_timings = defaultdict(list)
+    failed = 0
+    for future in as_completed(futures):
+        entry_id, connector_id = futures[future]
+        # future.result() only re-raises exceptions that are truthy,
+        # and a CloudFlareAPIError without an error chain has a length
+        # of 0, so the exception is checked for explicitly.
+        e = future.exception()
+        if isinstance(e, (requests.RequestException, CloudFlareAPIError)):
+            logger.error('Could not create tunnel for connector %s: %s',
+                         connector_id or '(pool)', e)
+            if isinstance(e, CloudFlareAPIError):
+                # a rejected create (a name that is already taken, for
+                # example) means Cloudflare knows things we don't.
+                inventory.mark_drift(f'Could not create tunnel: {e}')
+            metrics.tunnels_failed.inc()
+            failed += 1
+            if entry_id is not None:
+                delay = tunnel_mng.retry_pending(
+                    entry_id, connector_id,
+                    env.CONNECT_PROVISION_RETRY_DELAY,
+                    env.CONNECT_PROVISION_RETRY_MAX_DELAY)
+                logger.info('Retrying connector %s in %.1fs.',
+                            connector_id, delay)
+            continue
+        timings = future.result()
+        if entry_id is not None:
+            tunnel_mng.ack_pending(entry_id)
+        metrics.tunnels_provisioned.labels(
+            'pool' if connector_id is None else 'connector').inc()
+        for stage, elapsed in timings.items():
+            stage_timings[stage].append(elapsed)
+            metrics.tunnel_stage_seconds.labels(stage).observe(elapsed)
+
+    release_leases(redis, [
+        get_provision_lease_key(connector_id)
+        for _, connector_id, _ in jobs
+        if connector_id is not None
+    ], worker_name)
+
+    elapsed = time.monotonic() - start
+    stages = ', '.join(
+        f'{stage}={sum(values) / len(values):.3f}/{max(values):.3f}'
+        for stage, values in stage_timings.items()
+    )
+    logger.info(
+        'Provisioned %d of %d tunnel(s) in %.3fs. '
+        'Stage latency avg/max (s): %s',
+        len(jobs) - failed, len(jobs), elapsed, stages or '-')
 
-    return wrapper
+
+def get_all_pages(endpoint, *args, params=None, per_page=100):
+    # The list end-points are paginated, so a plain get only returns
+    # the first page.
+    results = []
+    page = 1
+    while True:
+        page_params = dict(params or {}, page=page, per_page=per_page)
+        items = endpoint.get(*args, params=page_params)
+        results.extend(items)
+        if len(items) < per_page:
+            return results
+        page += 1
 
 
-@retry
 def get_all_cf_tunnels():
-    cf_tunnels = cf.accounts.cfd_tunnel.get(
-        account_id, params={'is_deleted': 'false'},
+    return get_all_pages(
+        get_cf().accounts.cfd_tunnel, account_id,
+        params={'is_deleted': 'false'},
     )
-    cf_tunnels = [
-        t for t in cf_tunnels
-        if t['name'].startswith(env.CONNECT_SUBDOMAIN_PREFIX)
-    ]
-    return cf_tunnels
 
 
-@retry
 def delete_cf_tunnel(tunnel_id):
-    cf.accounts.cfd_tunnel.delete(account_id, tunnel_id)
+    get_cf().accounts.cfd_tunnel.delete(account_id, tunnel_id)
 
 
-@retry
 def get_all_dns_records(zone_id):
-    return cf.zones.dns_records.get(zone_id)
+    return get_all_pages(
+        get_cf().zones.dns_records, zone_id,
+        params={'type': 'CNAME'},
+    )
 
 
-@retry
 def delete_dns_record(zone_id, dns_record_id):
-    cf.zones.dns_records.delete(zone_id, dns_record_id)
-
-
-def main():
-    global cf, tunnel_mng
-
-    config_logging()
-    redis = get_redis(decode_responses=True)
-
-    signal.signal(signal.SIGINT, signal_handler)
-    signal.signal(signal.SIGTERM, signal_handler)
-
-    cf = CloudFlare()
-    tunnel_mng = TunnelManager(redis)
-
-    logger.info('Started.')
-
-    while keep_running:
-        reject = False
-        reject_reason = None
-        cf_tunnels = get_all_cf_tunnels()
-        if len(cf_tunnels) >= max_tunnels:
-            reject = True
-            reject_reason = 'No free tunnels available.'
-            logger.info(
-                'Hit max number of tunnels. Will reject requests.')
-        else:
-            logger.debug(
-                f'There are {len(cf_tunnels)} existing cf tunnels '
-                f'(max={max_tunnels})')
-
-        for key in redis.scan_iter('tunnel:*'):
-            tunnel = redis.get(key)
-            tunnel = json.loads(tunnel)
-            if tunnel['hostname'] is not None:
+    get_cf().zones.dns_records.delete(zone_id, dns_record_id)
+
+
+def sync_inventory():
+    drift = inventory.get_drift()
+    if drift:
+        logger.info('Re-syncing Cloudflare inventory: %s', drift)
+    else:
+        logger.info('Re-syncing Cloudflare inventory...')
+    # other workers keep provisioning while we list, and the tunnels
+    # and DNS records they add in the meantime must not be dropped.
+    started_at = time.time()
+    cf_tunnels = get_all_cf_tunnels()
+    dns_records = get_all_dns_records(zone_id)
+    inventory.replace(cf_tunnels, dns_records, started_at)
+    logger.info('Cloudflare inventory synced: %d tunnel(s).',
+                inventory.count_tunnels())
+    cf_stats.log()
+
+
+def collect_garbage(active_cf_tunnel_ids):
+    # if there are cf tunnels that are not in our redis records,
+    # delete them.
+
+    # tunnels that are being provisioned (maybe by another worker)
+    # exist before their tunnel records do, so new tunnels are left
+    # alone for a while.
+    grace_deadline = time.time() - env.CONNECT_GC_GRACE_PERIOD
+
+    with metrics.loop_phase_seconds.labels('tunnel_gc').time():
+        existing_cf_tunnel_ids = set()
+        orphaned = 0
+        for cf_tunnel in inventory.get_tunnels():
+            existing_cf_tunnel_ids.add(cf_tunnel['id'])
+            if cf_tunnel['created_at'] > grace_deadline:
                 continue
-
-            _, connector_id = key.split(':', maxsplit=1)
-
-            if reject:
-                tunnel_mng.write_tunnel(
-                    connector_id, tunnel['tunnel_name'],
-                    status='rejected',
-                    reject_reason=reject_reason)
-                continue
-
-            logger.info(
-                f'Creating tunnel for connector: {connector_id}...')
-
-            create_tunnel(connector_id, tunnel['tunnel_name'])
-
-        active_cf_tunnel_ids = []
-        for key in redis.scan_iter('tunnel:*'):
-            _, connector_id = key.split(':', maxsplit=1)
-            tunnel = redis.get(f'tunnel:{connector_id}')
-            tunnel = json.loads(tunnel)
-            cf_tunnel_creds = tunnel.get('cfd_creds', {})
-            cf_tunnel_id = cf_tunnel_creds.get('TunnelID')
-            if cf_tunnel_id:
-                active_cf_tunnel_ids.append(cf_tunnel_id)
-
-        # if there are cf tunnels that are not in our redis records,
-        # delete them.
-
-        cf_tunnels = get_all_cf_tunnels()
-
-        existing_cf_tunnel_ids = []
-        for cf_tunnel in cf_tunnels:
-            existing_cf_tunnel_ids.append(cf_tunnel['id'])
             if cf_tunnel['id'] not in active_cf_tunnel_ids:
-                logger.info(
-                    f'Deleting unused cf tunnel: {cf_tunnel["id"]}')
+                orphaned += 1
+                logger.info('Deleting unused cf tunnel: %s', cf_tunnel['id'])
                 try:
                     delete_cf_tunnel(cf_tunnel['id'])
                 except CloudFlareAPIError as e:
@@ -228,33 +380,234 @@ def main():
                         'cloudflared instance is still connected.')
                     continue
 
-                existing_cf_tunnel_ids.pop()
+                existing_cf_tunnel_ids.remove(cf_tunnel['id'])
+                inventory.remove_tunnel(cf_tunnel['id'])
+                metrics.tunnels_deleted.inc()
                 logger.info('Deleted unused cf tunnel.')
+        metrics.orphaned_tunnels.set(orphaned)
 
-        # if there are any dns records not matching existing cf
-        # tunnels, delete them.
+    # if there are any dns records not matching existing cf
+    # tunnels, delete them. like tunnels, new ones are left alone for
+    # a while, since their tunnel might not be in our inventory yet.
 
-        all_dns_records = get_all_dns_records(zone_id)
-        for dns_record in all_dns_records:
-            if dns_record['type'] != 'CNAME':
-                continue
-            name = dns_record['name']
-            if not name.startswith(env.CONNECT_SUBDOMAIN_PREFIX):
+    with metrics.loop_phase_seconds.labels('dns_gc').time():
+        for dns_record in inventory.get_dns_records():
+            if dns_record.get('created_at', 0) > grace_deadline:
                 continue
-            target = dns_record['content']
-            if not target.endswith('.cfargotunnel.com'):
-                continue
-            cf_tunnel_id = target[:-len('.cfargotunnel.com')]
+            cf_tunnel_id = get_record_tunnel_id(dns_record)
             if cf_tunnel_id not in existing_cf_tunnel_ids:
-                logger.info(f'Deleting unused DNS record: {dns_record["id"]}')
-                delete_dns_record(zone_id, dns_record['id'])
-                logger.info(f'DNS record deleted.')
+                logger.info(
+                    'Deleting unused DNS record: %s', dns_record['id'])
+                try:
+                    delete_dns_record(zone_id, dns_record['id'])
+                except CloudFlareAPIError as e:
+                    # most likely someone else already deleted it.
+                    inventory.mark_drift(
+                        f'Could not delete DNS record '
+                        f'{dns_record["id"]}: {e}')
+                    continue
+                inventory.remove_dns_record(dns_record['id'])
+                metrics.dns_records_deleted.inc()
+                logger.info('DNS record deleted.')
+
+
+def handle_pending(entries, refill_pool):
+    # Provision tunnels for the given pending queue entries, as far as
+    # there is room for them, and reject the rest. If refill_pool is
+    # set, whatever room is left goes to topping up the tunnel pool.
+    # Returns whether any connector was rejected.
+
+    # make sure each connector is only handled by one worker (and
+    # once) at a time. the tunnel records are only read after that, so
+    # we don't act on a record someone else has just updated.
+    leases = acquire_leases(
+        redis,
+        [get_provision_lease_key(cid) for _, cid in entries],
+        worker_name,
+        env.CONNECT_PROVISION_LEASE_TTL)
+    # entries someone else holds the lease for are left un-acknowledged:
+    # if that worker has crashed, they are re-claimed once the lease has
+    # expired (see TUNNEL_PENDING_CLAIM_IDLE), and if not, they are
+    # acknowledged then as already provisioned.
+    owned = [
+        entry for entry, leased in zip(entries, leases) if leased
+    ]
+
+    tunnels = tunnel_mng.read_tunnels(
+        [connector_id for _, connector_id in owned])
+    pending = []
+    for (entry_id, connector_id), tunnel in zip(owned, tunnels):
+        if tunnel is None or tunnel['hostname'] is not None:
+            # either expired, or already provisioned through an
+            # earlier (duplicate) queue entry.
+            tunnel_mng.ack_pending(entry_id)
+            release_leases(
+                redis, [get_provision_lease_key(connector_id)],
+                worker_name)
+            continue
+        pending.append((entry_id, connector_id, tunnel['tunnel_name']))
+
+    pool_missing = 0
+    if refill_pool:
+        pool_missing = max(0, pool_size - tunnel_mng.get_pool_size())
+    wanted = len(pending) + pool_missing
+    if wanted == 0:
+        return False
+
+    # only as many connectors as there is room for on Cloudflare get a
+    # tunnel; the rest are rejected.
+    free_slots = inventory.reserve_slots(
+        worker_name, wanted, max_tunnels,
+        env.CONNECT_PROVISION_LEASE_TTL)
+    logger.debug('Reserved %d of %d wanted tunnel slot(s) (max=%d)',
+                 free_slots, wanted, max_tunnels)
+
+    jobs = pending[:free_slots]
+    rejected = pending[free_slots:]
+    if rejected:
+        logger.info('Hit max number of tunnels. Will reject requests.')
+        metrics.tunnels_rejected.inc(len(rejected))
+    for entry_id, connector_id, tunnel_name in rejected:
+        tunnel_mng.write_tunnel(
+            connector_id, tunnel_name,
+            status='rejected',
+            reject_reason='No free tunnels available.')
+        tunnel_mng.ack_pending(entry_id)
+    release_leases(redis, [
+        get_provision_lease_key(connector_id)
+        for _, connector_id, _ in rejected
+    ], worker_name)
+
+    for _, connector_id, _ in jobs:
+        logger.info('Creating tunnel for connector: %s...', connector_id)
+
+    pool_jobs = min(pool_missing, free_slots - len(jobs))
+    if pool_jobs > 0:
+        logger.info('Adding %d tunnel(s) to the pool...', pool_jobs)
+        for _ in range(pool_jobs):
+            jobs.append((None, None, get_pool_tunnel_name()))
+
+    try:
+        provision_tunnels(jobs)
+    finally:
+        inventory.release_slots(worker_name)
+
+    return bool(rejected)
+
+
+def main():
+    config_logging()
+    env.get_config()
+    redis = get_redis(decode_responses=True)
+
+    signal.signal(signal.SIGINT, signal_handler)
+    signal.signal(signal.SIGTERM, signal_handler)
+
+    if env.CONNECT_METRICS_PORT:
+        start_http_server(env.CONNECT_METRICS_PORT)
 
-        time.sleep(5 if reject else 1)
+    run(redis)
 
+
+def update_gauges(is_leader):
+    pending, oldest_age = tunnel_mng.get_pending_stats()
+    metrics.pending_tunnels.set(pending)
+    metrics.oldest_pending_seconds.set(oldest_age)
+    metrics.active_tunnels.set(tunnel_mng.count_active_tunnels())
+    metrics.pooled_tunnels.set(tunnel_mng.get_pool_size())
+    metrics.cf_tunnels.set(inventory.count_tunnels())
+    metrics.is_leader.set(1 if is_leader else 0)
+
+
+def run(redis_client):
+    # The worker loop. Runs until keep_running is cleared.
+    global redis, tunnel_mng, inventory, provision_pool, cf_bucket
+
+    redis = redis_client
+    tunnel_mng = TunnelManager(redis)
+    inventory = CloudflareInventory(redis)
+    cf_bucket = TokenBucket(redis)
+    provision_pool = ThreadPoolExecutor(
+        max_workers=env.CONNECT_PROVISION_CONCURRENCY,
+        thread_name_prefix='provision')
+
+    # any number of workers can provision tunnels for pending
+    # connectors, since the queue's consumer group hands each entry to
+    # just one of them. everything that needs a consistent view of all
+    # tunnels (inventory syncs, topping up the pool and garbage
+    # collection) is only done by the leader.
+    leader = Lease(redis, 'connect:worker-leader', worker_name,
+                   env.CONNECT_LEADER_LEASE_TTL)
+    is_leader = False
+
+    logger.info('Started as %s.', worker_name)
+    if tunnel_mng.pending_claim_idle <= env.CONNECT_PROVISION_LEASE_TTL:
+        logger.warning(
+            'TUNNEL_PENDING_CLAIM_IDLE should be longer than '
+            'CONNECT_PROVISION_LEASE_TTL, or the queue entries of a '
+            'crashed worker are re-claimed before its leases expire.')
+
+    tunnel_mng.create_pending_group()
+    indexed = False
+
+    reject = False
+    next_gauge_update = 0
+    while keep_running:
+        was_leader = is_leader
+        is_leader = leader.acquire()
+        if is_leader != was_leader:
+            logger.info(
+                'Became the leader.' if is_leader else 'Lost leadership.')
+
+        if is_leader and not indexed:
+            pending, active = tunnel_mng.index_existing_tunnels()
+            logger.info(
+                'Found %d pending and %d active tunnel record(s).',
+                pending, active)
+            indexed = True
+
+        if is_leader and inventory.needs_sync():
+            with metrics.loop_phase_seconds.labels('inventory_sync').time():
+                sync_inventory()
+
+        if time.monotonic() >= next_gauge_update:
+            with metrics.loop_phase_seconds.labels('gauges').time():
+                update_gauges(is_leader)
+            next_gauge_update = \
+                time.monotonic() + env.CONNECT_METRICS_INTERVAL
+
+        # block until new connectors show up, or until it's time for
+        # the next round of garbage collection.
+        with metrics.loop_phase_seconds.labels('wait').time():
+            tunnel_mng.requeue_due_retries()
+            entries = tunnel_mng.read_pending(
+                worker_name, block=5000 if reject else 1000)
+
+        with metrics.loop_phase_seconds.labels('provision').time():
+            reject = handle_pending(entries, refill_pool=is_leader)
+
+        # provisioning might have taken a while; make sure we're still
+        # the leader before deleting anything.
+        if not (is_leader and leader.acquire()):
+            continue
+
+        # the pool needs to be read before the active tunnel index: a
+        # tunnel claimed in between then still shows up in the latter.
+        with metrics.loop_phase_seconds.labels('active_scan').time():
+            active_cf_tunnel_ids = {
+                tunnel['cfd_creds']['TunnelID']
+                for tunnel in tunnel_mng.get_pooled_tunnels()
+            }
+            active_cf_tunnel_ids |= tunnel_mng.get_active_tunnel_ids()
+
+        collect_garbage(active_cf_tunnel_ids)
+
+    if is_leader:
+        leader.release()
+    provision_pool.shutdown()
+    cf_stats.log()
     logger.info('Done.')
 
 
 if __name__ == '__main__':
     main()
-
@@ -1,4 +1,4 @@
-from .redisutils import get_redis
+from .redisutils import get_redis, get_async_redis
 from .logutils import config_logging
 from . import env
 from .env import defenv
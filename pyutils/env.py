@@ -4,17 +4,20 @@ from dotenv import load_dotenv
 load_dotenv()
 
 _defs = {}
+_config = None
 
 
 def defenv(name: str, var_type: type, default=None, optional=True):
+    global _config
+
     if name in _defs:
         # if the environment variable already exists, accept the
         # definition only if the new definition is the same as the old
         # one.
         definition = _defs[name]
-        if definition['type'] != var_type or \
-           definition['default'] != default or \
-           definition['optional'] != optional:
+        if definition['type'] == var_type and \
+           definition['default'] == default and \
+           definition['optional'] == optional:
             return
         raise ValueError('Conflicting environment variable definition.')
 
@@ -24,6 +27,75 @@ def defenv(name: str, var_type: type, default=None, optional=True):
         'default': default,
         'optional': optional,
     }
+    # the snapshot is missing the new variable.
+    _config = None
+
+
+class Config:
+    # A read-only snapshot of the environment variables, parsed once.
+    # Every defined variable is a slot, so reading one is a plain
+    # attribute access. Subclassed by _load_config, with the slots of
+    # the variables defined at the time.
+
+    __slots__ = ()
+
+    def __init__(self, values):
+        for name, value in values.items():
+            object.__setattr__(self, name, value)
+
+    def __setattr__(self, name, value):
+        raise AttributeError('Config is read-only')
+
+    def __delattr__(self, name):
+        raise AttributeError('Config is read-only')
+
+    def __getattr__(self, name):
+        # only called for slots that were never set.
+        if name in _defs:
+            raise ValueError(f'Environment variable {name} not set')
+        raise AttributeError(f'Unknown environment variable: {name}')
+
+
+def get_config():
+    # Returns a Config with the values of all variables defined so far.
+    # It's built on first use (and again if more variables have been
+    # defined since), so calling this at start-up makes any variable
+    # that can't be parsed fail there, rather than on first use.
+    global _config
+    if _config is None:
+        _config = _load_config()
+    return _config
+
+
+def reload_config():
+    # Re-read the environment, for tests that change it.
+    global _config
+    _config = None
+    return get_config()
+
+
+def _load_config():
+    values = {}
+    errors = []
+    for name, definition in _defs.items():
+        value = os.environ.get(name)
+        if value is None:
+            # a required variable that is not set is only an error when
+            # it's read, since services import modules that define
+            # variables they don't need.
+            if definition['optional']:
+                values[name] = definition['default']
+            continue
+        try:
+            values[name] = definition['type'](value)
+        except ValueError as e:
+            errors.append(f'{name}: {e}')
+    if errors:
+        raise ValueError(
+            'Invalid environment variables: ' + '; '.join(errors))
+
+    config_class = type('Config', (Config,), {'__slots__': tuple(_defs)})
+    return config_class(values)
 
 
 def __getattr__(name):
@@ -1,34 +1,158 @@
-import logging.config
+import json
+import time
+import queue
+import atexit
+import logging
+import threading
+from logging.handlers import QueueHandler, QueueListener
 from .env import defenv
 from . import env
 
 defenv('LOG_LEVEL', str, default='INFO')
+# 'text' or 'json'
+defenv('LOG_FORMAT', str, default='text')
+# with a non-zero value, log records are written to stderr by a
+# background thread, instead of by whoever logs them.
+defenv('LOG_QUEUE', int, default=0)
+# with a non-zero value, at most this many records with the same
+# message (before formatting) are logged per LOG_RATE_INTERVAL seconds.
+defenv('LOG_RATE_LIMIT', int, default=0)
+defenv('LOG_RATE_INTERVAL', float, default=60.0)
 
+TEXT_FORMAT = '%(asctime)s [%(levelname)s] %(name)s: %(message)s'
+
+# attributes every log record has; anything else was passed in `extra`.
+RECORD_ATTRS = set(vars(logging.makeLogRecord({}))) | {'message', 'asctime'}
+
+_listener = None
+
+
+def config_logging(log_level=None, log_format=None, queued=None):
+    global _listener
 
-def config_logging(log_level=None):
     if log_level is None:
         log_level = env.LOG_LEVEL
+    if log_format is None:
+        log_format = env.LOG_FORMAT
+    if queued is None:
+        queued = bool(env.LOG_QUEUE)
     log_level = log_level.upper()
-    logging.config.dictConfig({
-        'version': 1,
-        'disable_existing_loggers': False,
-        'formatters': {
-            'standard': {
-                'format': '%(asctime)s [%(levelname)s] %(name)s: %(message)s',
-            }
-        },
-        'handlers': {
-            'default': {
-                'level': log_level,
-                'class': 'logging.StreamHandler',
-                'formatter': 'standard',
-            }
-        },
-        'loggers': {
-            '': {
-                'handlers': ['default'],
-                'level': log_level,
-                'propagate': True,
-            },
+
+    if log_format == 'json':
+        formatter = JsonFormatter()
+    elif log_format == 'text':
+        formatter = TextFormatter(TEXT_FORMAT)
+    else:
+        raise ValueError(f'Unknown log format: {log_format}')
+
+    handler = logging.StreamHandler()
+    handler.setLevel(log_level)
+    handler.setFormatter(formatter)
+
+    _stop_listener()
+    if queued:
+        log_queue = queue.SimpleQueue()
+        _listener = QueueListener(log_queue, handler,
+                                  respect_handler_level=True)
+        _listener.start()
+        handler = LocalQueueHandler(log_queue)
+
+    if env.LOG_RATE_LIMIT:
+        handler.addFilter(
+            RateLimitFilter(env.LOG_RATE_LIMIT, env.LOG_RATE_INTERVAL))
+
+    root = logging.getLogger()
+    for old_handler in root.handlers[:]:
+        root.removeHandler(old_handler)
+    root.addHandler(handler)
+    root.setLevel(log_level)
+
+
+@atexit.register
+def _stop_listener():
+    # writes out whatever is still queued.
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+class LocalQueueHandler(QueueHandler):
+    # QueueHandler formats the record before queueing it, so it can be
+    # sent to another process. Ours stays in this one, so formatting
+    # (the expensive part) is left to the listener's thread. The catch
+    # is that mutable arguments are formatted as they are at that time.
+
+    def prepare(self, record):
+        return record
+
+
+class RateLimitFilter(logging.Filter):
+    # Lets through at most `limit` records with the same logger, level
+    # and message (before formatting, so pass the variable parts as
+    # arguments rather than in an f-string) per `interval` seconds. The
+    # first record let through after some were dropped carries the
+    # number of dropped ones in its `suppressed` attribute.
+
+    def __init__(self, limit, interval):
+        super().__init__()
+        self.limit = limit
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._window_start = time.monotonic()
+        self._counts = {}
+        self._suppressed = {}
+
+    def filter(self, record):
+        key = (record.name, record.levelno, str(record.msg))
+        now = time.monotonic()
+        with self._lock:
+            if now - self._window_start >= self.interval:
+                self._window_start = now
+                self._suppressed = {
+                    k: count - self.limit
+                    for k, count in self._counts.items()
+                    if count > self.limit
+                }
+                self._counts = {}
+
+            count = self._counts.get(key, 0) + 1
+            self._counts[key] = count
+            if count > self.limit:
+                return False
+            suppressed = self._suppressed.pop(key, 0)
+
+        if suppressed:
+            record.suppressed = suppressed
+        return True
+
+
+class TextFormatter(logging.Formatter):
+    def format(self, record):
+        text = super().format(record)
+        suppressed = getattr(record, 'suppressed', 0)
+        if suppressed:
+            text += f' ({suppressed} similar message(s) suppressed)'
+        return text
+
+
+class JsonFormatter(logging.Formatter):
+    # One json object per line, with any `extra` fields of the record
+    # included as they are (or as strings, if they're not
+    # serializable).
+
+    def format(self, record):
+        data = {
+            'time': record.created,
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
         }
-    })
+        if record.exc_info:
+            data['exception'] = self.formatException(record.exc_info)
+        if record.stack_info:
+            data['stack'] = self.formatStack(record.stack_info)
+        for name, value in vars(record).items():
+            if name not in RECORD_ATTRS:
+                data[name] = value
+        return json.dumps(data, default=str)
@@ -1,8 +1,14 @@
+import os
 import sys
 import time
+import asyncio
 import logging
-from redis import Redis
+import threading
+from redis import Redis, ConnectionPool
+from redis.asyncio import Redis as AsyncRedis
+from redis.asyncio import ConnectionPool as AsyncConnectionPool
 from redis.exceptions import ConnectionError as RedisConnectionError
+from redis.exceptions import TimeoutError as RedisTimeoutError
 from .env import defenv
 from . import env
 
@@ -10,34 +16,124 @@ logger = logging.getLogger(__name__)
 
 defenv('REDIS_MAIN', str, default='redis')
 defenv('REDIS_MAX_RETRIES', int, default=30)
+defenv('REDIS_DB', int, default=0)
+# blocking commands (like XREADGROUP) must block for less than this.
+defenv('REDIS_SOCKET_TIMEOUT', float, default=30.0)
+defenv('REDIS_SOCKET_CONNECT_TIMEOUT', float, default=5.0)
+defenv('REDIS_HEALTH_CHECK_INTERVAL', int, default=30)
+defenv('REDIS_RETRY_MIN_DELAY', float, default=0.01)
+defenv('REDIS_RETRY_MAX_DELAY', float, default=1.0)
+
+# connection pools shared by all clients to the same server, keyed by
+# (host, port, db, decode_responses), and for the asyncio pools, the
+# event loop as well.
+_pools = {}
+_async_pools = {}
+_pools_lock = threading.Lock()
+
+
+def _reset_pools():
+    # connections inherited from the parent process are the parent's to
+    # use, so a forked child (like a gunicorn worker) starts over.
+    global _pools_lock
+    _pools.clear()
+    _async_pools.clear()
+    _pools_lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=_reset_pools)
 
 
 def get_redis(port=6379, decode_responses=False):
     redis_host = env.REDIS_MAIN
-    redis = Redis(host=redis_host, port=port,
-                  decode_responses=decode_responses)
-    make_sure_redis_is_up(redis, redis_host, port)
+    key = (redis_host, port, env.REDIS_DB, decode_responses)
+    with _pools_lock:
+        pool = _pools.get(key)
+        if pool is None:
+            pool = ConnectionPool(**_get_pool_args(*key))
+            _pools[key] = pool
+            new_pool = True
+        else:
+            new_pool = False
+
+    redis = Redis(connection_pool=pool)
+    if new_pool:
+        make_sure_redis_is_up(redis, redis_host, port)
     return redis
 
 
-def make_sure_redis_is_up(redis, redis_host, redis_port):
-    max_retries = env.REDIS_MAX_RETRIES
-    retries = 0
+async def get_async_redis(port=6379, decode_responses=False):
+    # Same as get_redis, for asyncio code.
+    redis_host = env.REDIS_MAIN
+    key = (redis_host, port, env.REDIS_DB, decode_responses,
+           asyncio.get_running_loop())
+    pool = _async_pools.get(key)
+    new_pool = pool is None
+    if new_pool:
+        pool = AsyncConnectionPool(**_get_pool_args(*key[:4]))
+        _async_pools[key] = pool
+
+    redis = AsyncRedis(connection_pool=pool)
+    if new_pool:
+        await make_sure_async_redis_is_up(redis, redis_host, port)
+    return redis
+
+
+def _get_pool_args(host, port, db, decode_responses):
+    return {
+        'host': host,
+        'port': port,
+        'db': db,
+        'decode_responses': decode_responses,
+        'socket_timeout': env.REDIS_SOCKET_TIMEOUT,
+        'socket_connect_timeout': env.REDIS_SOCKET_CONNECT_TIMEOUT,
+        'socket_keepalive': True,
+        'health_check_interval': env.REDIS_HEALTH_CHECK_INTERVAL,
+    }
 
-    while True:
+
+def make_sure_redis_is_up(redis, redis_host, redis_port):
+    for delay in _get_retry_delays():
         try:
             # We need to attempt sending a command to redis to see if
             # it's actually available.
-            redis.get('_dummy_key_readiness_check')
-        except RedisConnectionError:
-            logger.warning('Redis not up yet at %s:%d . Re-trying...',
-                           redis_host, redis_port)
-            time.sleep(1.0)
-            retries += 1
-
-            if retries >= max_retries:
-                logger.error("Maximum retries (%s) reached, "
-                             "attempting to connect to redis. Aborting.", max_retries)
-                sys.exit(1)
-        else:
+            redis.ping()
+            return
+        except (RedisConnectionError, RedisTimeoutError):
+            _log_retry(redis_host, redis_port, delay)
+            time.sleep(delay)
+    _give_up()
+
+
+async def make_sure_async_redis_is_up(redis, redis_host, redis_port):
+    for delay in _get_retry_delays():
+        try:
+            await redis.ping()
             return
+        except (RedisConnectionError, RedisTimeoutError):
+            _log_retry(redis_host, redis_port, delay)
+            await asyncio.sleep(delay)
+    _give_up()
+
+
+def _get_retry_delays():
+    # Exponential backoff, starting at a few milliseconds, so that we
+    # don't wait a whole second when redis is only just starting (or
+    # restarting).
+    delay = env.REDIS_RETRY_MIN_DELAY
+    max_delay = env.REDIS_RETRY_MAX_DELAY
+    for _ in range(env.REDIS_MAX_RETRIES):
+        yield delay
+        delay = min(delay * 2, max_delay)
+
+
+def _log_retry(redis_host, redis_port, delay):
+    logger.warning('Redis not up yet at %s:%d . Re-trying in %.2fs...',
+                   redis_host, redis_port, delay)
+
+
+def _give_up():
+    logger.error("Maximum retries (%s) reached, "
+                 "attempting to connect to redis. Aborting.",
+                 env.REDIS_MAX_RETRIES)
+    sys.exit(1)
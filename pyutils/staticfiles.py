@@ -0,0 +1,103 @@
+import os
+import gzip
+import hashlib
+import mimetypes
+import brotli
+from flask import Response, request, abort
+
+# preferred first
+ENCODINGS = ('br', 'gzip')
+
+# for urls that change whenever their content does.
+IMMUTABLE = 'public, max-age=31536000, immutable'
+
+
+class StaticFile:
+    # A response body that doesn't change for the life of the process,
+    # compressed once with each encoding we support, with a strong etag
+    # for each of them.
+
+    def __init__(self, body, mimetype):
+        self.mimetype = mimetype
+        self.fingerprint = hashlib.sha1(body).hexdigest()
+        self.bodies = {
+            None: body,
+            'gzip': gzip.compress(body),
+            'br': brotli.compress(body),
+        }
+
+    def get_etag(self, encoding):
+        if encoding is None:
+            return self.fingerprint
+        return f'{self.fingerprint}-{encoding}'
+
+    def make_response(self, cache_control='no-cache'):
+        # With the default cache control, clients and caches keep the
+        # file but check with us before using it, which costs them a
+        # 304 when it hasn't changed.
+        encoding = choose_encoding(request.accept_encodings)
+        etag = self.get_etag(encoding)
+
+        headers = {
+            'ETag': f'"{etag}"',
+            'Cache-Control': cache_control,
+            'Vary': 'Accept-Encoding',
+        }
+        if request.if_none_match.contains(etag):
+            return Response(status=304, headers=headers)
+
+        if encoding is not None:
+            headers['Content-Encoding'] = encoding
+        return Response(
+            self.bodies[encoding],
+            mimetype=self.mimetype,
+            headers=headers,
+        )
+
+
+class StaticAssets:
+    # The files in a directory, served under fingerprinted names
+    # (index.js as index.<hash>.js), so they can be cached forever: a
+    # new version of a file gets a new url. Templates get the url of a
+    # file with asset_url('index.js'). Apps using this should be
+    # created with static_folder=None.
+
+    def __init__(self, directory, url_prefix='/static'):
+        self.url_prefix = url_prefix
+        self.files = {}
+        self.urls = {}
+        for name in sorted(os.listdir(directory)):
+            path = os.path.join(directory, name)
+            if not os.path.isfile(path):
+                continue
+            with open(path, 'rb') as f:
+                body = f.read()
+            mimetype, _ = mimetypes.guess_type(name)
+            static_file = StaticFile(
+                body, mimetype or 'application/octet-stream')
+            base, ext = os.path.splitext(name)
+            fingerprinted = f'{base}.{static_file.fingerprint[:12]}{ext}'
+            self.files[fingerprinted] = static_file
+            self.urls[name] = f'{url_prefix}/{fingerprinted}'
+
+    def init_app(self, app):
+        app.add_url_rule(f'{self.url_prefix}/<name>', 'static_asset',
+                         self.serve)
+        app.jinja_env.globals['asset_url'] = self.get_url
+
+    def get_url(self, name):
+        return self.urls[name]
+
+    def serve(self, name):
+        static_file = self.files.get(name)
+        if static_file is None:
+            abort(404)
+        return static_file.make_response(IMMUTABLE)
+
+
+def choose_encoding(accept_encoding):
+    # `accept_encoding` is werkzeug's parsed Accept-Encoding header.
+    for encoding in ENCODINGS:
+        if accept_encoding.quality(encoding) > 0:
+            return encoding
+    return None
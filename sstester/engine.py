@@ -0,0 +1,162 @@
+import ssl
+import time
+import socket
+import shutil
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+
+# any https server will do; an http response (whatever the status)
+# means the proxy works.
+PROBE_HOST = 'google.com'
+PROBE_PORT = 443
+
+# how long to wait between probes while ss-local is starting up.
+PROBE_INTERVAL = 0.1
+
+
+class Socks5Error(Exception):
+    pass
+
+
+async def test_configs(configs, concurrency, timeout):
+    # Tests the given configs, at most `concurrency` at a time, and
+    # returns a (status, error, response_time) tuple for each, in the
+    # same order.
+    semaphore = asyncio.Semaphore(concurrency)
+    ssl_context = ssl.create_default_context()
+
+    async def run(config):
+        async with semaphore:
+            return await test_config(config, timeout, ssl_context)
+
+    return await asyncio.gather(*(run(config) for config in configs))
+
+
+async def test_config(config, timeout, ssl_context):
+    logger.info('Testing: %s', config['title'])
+
+    port = get_free_port()
+    ss_local_args = [
+        shutil.which('ss-local') or 'ss-local',
+        '-s', config['remote_addr'],
+        '-p', str(config['remote_port']),
+        '-l', str(port),
+        '-k', config['password'],
+        '-m', config['method'],
+        '--plugin', config['plugin'],
+        '--plugin-opts', config['plugin_opts'],
+    ]
+
+    logger.debug('Executing: %s', ' '.join(ss_local_args))
+    try:
+        proc = await asyncio.create_subprocess_exec(
+            *ss_local_args,
+            stdout=asyncio.subprocess.DEVNULL,
+            stderr=asyncio.subprocess.DEVNULL)
+    except Exception as e:
+        logger.error('Error executing ss-local: %s', e)
+        return ('error', e, None)
+
+    start_time = time.monotonic()
+    try:
+        return await asyncio.wait_for(
+            wait_until_working(proc, port, ssl_context, start_time),
+            timeout)
+    except asyncio.TimeoutError:
+        return ('not-working', 'timeout', time.monotonic() - start_time)
+    finally:
+        if proc.returncode is None:
+            proc.kill()
+        await proc.wait()
+
+
+async def wait_until_working(proc, port, ssl_context, start_time):
+    while True:
+        if proc.returncode is not None:
+            return ('not-working', 'terminated', None)
+        try:
+            await probe(port, ssl_context)
+        except (OSError, Socks5Error, asyncio.IncompleteReadError):
+            logger.debug('Connection error while testing; waiting...')
+        else:
+            return ('working', 'success', time.monotonic() - start_time)
+        await asyncio.sleep(PROBE_INTERVAL)
+
+
+async def probe(port, ssl_context):
+    # Makes an https request through the socks5 proxy at the given
+    # local port, with the host name resolved by the proxy (like
+    # socks5h:// urls in requests), and returns the status line.
+    loop = asyncio.get_running_loop()
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setblocking(False)
+    try:
+        await loop.sock_connect(sock, ('127.0.0.1', port))
+        await socks5_connect(loop, sock, PROBE_HOST, PROBE_PORT)
+        reader, writer = await asyncio.open_connection(
+            sock=sock, ssl=ssl_context, server_hostname=PROBE_HOST)
+    except BaseException:
+        sock.close()
+        raise
+
+    try:
+        writer.write(
+            f'HEAD / HTTP/1.1\r\nHost: {PROBE_HOST}\r\n'
+            f'Connection: close\r\n\r\n'.encode('ascii'))
+        await writer.drain()
+        status_line = await reader.readline()
+        if not status_line.startswith(b'HTTP/'):
+            raise Socks5Error('No http response through proxy')
+        return status_line.decode('latin-1').strip()
+    finally:
+        writer.close()
+
+
+async def socks5_connect(loop, sock, host, port):
+    # no authentication
+    await loop.sock_sendall(sock, b'\x05\x01\x00')
+    reply = await _recv_exactly(loop, sock, 2)
+    if reply != b'\x05\x00':
+        raise Socks5Error(f'Unexpected greeting reply: {reply!r}')
+
+    host = host.encode('idna')
+    await loop.sock_sendall(
+        sock,
+        b'\x05\x01\x00\x03' + bytes([len(host)]) + host +
+        port.to_bytes(2, 'big'))
+    reply = await _recv_exactly(loop, sock, 4)
+    if reply[1] != 0:
+        raise Socks5Error(f'Connect failed with code {reply[1]}')
+
+    # the rest of the reply is the bound address, which we don't need.
+    address_type = reply[3]
+    if address_type == 1:
+        await _recv_exactly(loop, sock, 4 + 2)
+    elif address_type == 4:
+        await _recv_exactly(loop, sock, 16 + 2)
+    elif address_type == 3:
+        length = (await _recv_exactly(loop, sock, 1))[0]
+        await _recv_exactly(loop, sock, length + 2)
+    else:
+        raise Socks5Error(f'Unknown address type: {address_type}')
+
+
+async def _recv_exactly(loop, sock, size):
+    data = b''
+    while len(data) < size:
+        chunk = await loop.sock_recv(sock, size - len(data))
+        if not chunk:
+            raise asyncio.IncompleteReadError(data, size)
+        data += chunk
+    return data
+
+
+def get_free_port():
+    # Lets the kernel pick a free port. Someone else could grab it
+    # before ss-local binds to it, but unlike fixed ports, it won't
+    # collide with another run, or with ports left in TIME_WAIT.
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
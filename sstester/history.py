@@ -0,0 +1,107 @@
+import json
+import hashlib
+
+# hash of config fingerprint -> json record with the latest test result
+# and when the config should be tested next.
+HISTORY_KEY = 'sstester:history'
+
+
+class TestHistory:
+    # Remembers test results across runs, so that each run only tests
+    # the configs that are due. Working configs are tested every
+    # `interval` seconds; failing ones back off exponentially, up to
+    # `max_backoff` seconds between tests.
+
+    def __init__(self, redis, interval, max_backoff, grace, retention):
+        self.redis = redis
+        self.interval = interval
+        self.max_backoff = max_backoff
+        # runs don't start exactly `interval` seconds apart, so
+        # anything due within this many seconds is tested now rather
+        # than a whole run later.
+        self.grace = grace
+        # records of configs we haven't seen for this long are dropped.
+        self.retention = retention
+
+    def load(self):
+        return {
+            _decode(fingerprint): json.loads(record)
+            for fingerprint, record in self.redis.hgetall(HISTORY_KEY).items()
+        }
+
+    def is_due(self, record, now):
+        if record is None:
+            return True
+        return record['next_test_at'] <= now + self.grace
+
+    def update(self, record, status, error, response_time, now):
+        # Returns the new record for a config that was just tested.
+        failures = 0
+        if status == 'error':
+            # the test couldn't be run at all (ss-local is missing, for
+            # example), which says nothing about the server: its last
+            # result (if any) is kept, and it's tried again at the
+            # normal interval.
+            if record is not None:
+                return dict(record, next_test_at=now + self.interval,
+                            last_seen=now)
+        elif status != 'working':
+            failures = (record['failures'] if record else 0) + 1
+
+        if failures:
+            delay = min(self.max_backoff,
+                        self.interval * 2 ** (failures - 1))
+        else:
+            delay = self.interval
+
+        return {
+            'status': status,
+            'error': str(error),
+            'response_time': response_time,
+            'tested_at': now,
+            'failures': failures,
+            'next_test_at': now + delay,
+            'last_seen': now,
+        }
+
+    def save(self, records, now):
+        # `records` are the records of every config seen in this run.
+        for record in records.values():
+            record['last_seen'] = now
+        if records:
+            self.redis.hset(HISTORY_KEY, mapping={
+                fingerprint: json.dumps(record)
+                for fingerprint, record in records.items()
+            })
+
+    def prune(self, records, seen, now):
+        # `records` are the records loaded at the start of the run, and
+        # `seen` the fingerprints of the configs seen in this run.
+        expired = [
+            fingerprint
+            for fingerprint, record in records.items()
+            if fingerprint not in seen and
+            now - record['last_seen'] > self.retention
+        ]
+        if expired:
+            self.redis.hdel(HISTORY_KEY, *expired)
+        return len(expired)
+
+
+def get_fingerprint(config):
+    # Configs that only differ in name are the same server, and are
+    # only tested once.
+    key = json.dumps([
+        config['remote_addr'],
+        config['remote_port'],
+        config['method'],
+        config['password'],
+        config['plugin_opts'],
+    ])
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+
+def _decode(value):
+    if isinstance(value, bytes):
+        return value.decode('ascii')
+    return value
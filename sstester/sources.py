@@ -0,0 +1,104 @@
+import re
+import json
+import hashlib
+import logging
+import requests
+from concurrent.futures import ThreadPoolExecutor
+
+# hash of source (url or file path) -> json record with the validators
+# of the last response, the hash of its content, and the urls found in
+# it.
+SOURCES_KEY = 'sstester:sources'
+
+URL_PATTERN = re.compile(r'ss://.+$', re.MULTILINE)
+
+logger = logging.getLogger(__name__)
+
+
+def fetch_urls(redis, sources, timeout):
+    # Returns the ss:// urls found in all the given sources (urls or
+    # local files), fetched concurrently, in order and without
+    # duplicates. A source that fails contributes the urls it had last
+    # time.
+    sources = list(dict.fromkeys(sources))
+    cached = {
+        _decode(source): json.loads(record)
+        for source, record in redis.hgetall(SOURCES_KEY).items()
+    }
+
+    with ThreadPoolExecutor(max_workers=max(1, len(sources))) as executor:
+        records = list(executor.map(
+            lambda source: fetch_source(source, cached.get(source), timeout),
+            sources))
+
+    updated = {
+        source: json.dumps(record)
+        for source, record in zip(sources, records)
+        if record != cached.get(source)
+    }
+    if updated:
+        redis.hset(SOURCES_KEY, mapping=updated)
+
+    urls = dict.fromkeys(
+        url for record in records for url in record['urls'])
+    return list(urls)
+
+
+def fetch_source(source, cached, timeout):
+    try:
+        if source.startswith(('http://', 'https://')):
+            return fetch_remote(source, cached, timeout)
+        return read_local(source, cached)
+    except (requests.RequestException, OSError) as e:
+        logger.error('Error fetching %s: %s', source, e)
+        if cached is not None:
+            return cached
+        return {'urls': []}
+
+
+def fetch_remote(source, cached, timeout):
+    headers = {}
+    if cached is not None:
+        if cached.get('etag'):
+            headers['If-None-Match'] = cached['etag']
+        if cached.get('last_modified'):
+            headers['If-Modified-Since'] = cached['last_modified']
+
+    resp = requests.get(source, headers=headers, timeout=timeout)
+    if resp.status_code == 304 and cached is not None:
+        logger.info('%s: not modified', source)
+        return cached
+    resp.raise_for_status()
+
+    record = parse(source, resp.content, cached)
+    record['etag'] = resp.headers.get('ETag')
+    record['last_modified'] = resp.headers.get('Last-Modified')
+    return record
+
+
+def read_local(source, cached):
+    with open(source, 'rb') as f:
+        content = f.read()
+    return parse(source, content, cached)
+
+
+def parse(source, content, cached):
+    # Servers don't always support conditional requests, so the urls
+    # are only extracted again if the content has actually changed.
+    content_hash = hashlib.sha256(content).hexdigest()
+    if cached is not None and cached.get('content_hash') == content_hash:
+        logger.info('%s: unchanged', source)
+        urls = cached['urls']
+    else:
+        urls = URL_PATTERN.findall(content.decode('utf-8', 'replace'))
+        logger.info('%s: found %d url(s)', source, len(urls))
+    return {
+        'content_hash': content_hash,
+        'urls': urls,
+    }
+
+
+def _decode(value):
+    if isinstance(value, bytes):
+        return value.decode('utf-8')
+    return value
@@ -4,21 +4,46 @@ import os
 import re
 import time
 import json
-import shutil
 import base64
+import asyncio
 import logging
-import subprocess
-import requests
-from multiprocessing import Pool
 from urllib.parse import urlparse, parse_qs
 from pyutils import get_redis, config_logging
+from . import engine, sources
+from .history import TestHistory, get_fingerprint
 
 DEFAULT_SCRAPE_URL = 'https://raw.githubusercontent.com/WeAreMahsaAmini/FreeInternet/main/guides/shadowsocks-v2ray-tls/CONFIGS.md'
 SCRAPE_URL = os.environ.get('SCRAPE_URL', DEFAULT_SCRAPE_URL)
 
+# urls and/or local files to look for configs in, separated by spaces
+# or commas. SCRAPE_URL is only used if this is not set.
+SCRAPE_SOURCES = re.split(
+    r'[\s,]+', os.environ.get('SCRAPE_SOURCES', SCRAPE_URL).strip())
+
+DEFAULT_SCRAPE_TIMEOUT = 30.0
+SCRAPE_TIMEOUT = float(
+    os.environ.get('SCRAPE_TIMEOUT', DEFAULT_SCRAPE_TIMEOUT))
+
 DEFAULT_TEST_TIMEOUT = 60.0
 TEST_TIMEOUT = int(os.environ.get('TEST_TIMEOUT', DEFAULT_TEST_TIMEOUT))
 
+# how many configs are tested at the same time. with enough of them,
+# the whole run takes about one TEST_TIMEOUT.
+DEFAULT_TEST_CONCURRENCY = 200
+TEST_CONCURRENCY = int(
+    os.environ.get('TEST_CONCURRENCY', DEFAULT_TEST_CONCURRENCY))
+
+# working configs are tested this often (in seconds); failing ones back
+# off exponentially, up to TEST_MAX_BACKOFF between tests.
+DEFAULT_TEST_INTERVAL = 300
+TEST_INTERVAL = int(os.environ.get('TEST_INTERVAL', DEFAULT_TEST_INTERVAL))
+DEFAULT_TEST_MAX_BACKOFF = 24 * 3600
+TEST_MAX_BACKOFF = int(
+    os.environ.get('TEST_MAX_BACKOFF', DEFAULT_TEST_MAX_BACKOFF))
+
+# results of configs that haven't been seen for this long are forgotten.
+HISTORY_RETENTION = 7 * 24 * 3600
+
 logger = logging.getLogger(__name__)
 
 
@@ -78,88 +103,23 @@ def get_config_from_android_url(parsed_url):
     }
 
 
-def test_android_url(config, index):
-    logger.info(f'Testing: {config["title"]}')
-
-    # this method of port selection is not generally robust, but in a
-    # container it's going to work fine.
-    port = 1080 + index
-
-    ss_local_args = [
-        shutil.which('ss-local'),
-        '-s', config['remote_addr'],
-        '-p', str(config['remote_port']),
-        '-l', str(port),
-        '-k', config['password'],
-        '-m', config['method'],
-        '--plugin', config['plugin'],
-        '--plugin-opts', config['plugin_opts'],
-    ]
-
-    logger.debug(f'Executing: {" ".join(ss_local_args)}')
-    try:
-        proc = subprocess.Popen(
-            ss_local_args,
-            stdout=subprocess.DEVNULL,
-            stderr=subprocess.DEVNULL)
-    except Exception as e:
-        logger.error(f'Error executing ss-local: {e}')
-        return ('error', e, None)
-
-    proxies = {
-        'http': f'socks5h://localhost:{port}',
-        'https': f'socks5h://localhost:{port}',
-    }
-    time_spent = 0
-    last_exception = None
-    start_time = time.monotonic()
-    while True:
-        if proc.poll() is not None:
-            # ss-local terminated
-            proc.kill()
-            return ('not-working', 'terminated', None)
-        try:
-            resp = requests.get('https://google.com',
-                                proxies=proxies,
-                                timeout=TEST_TIMEOUT)
-        except requests.ConnectionError as e:
-            logger.debug('Connection error while testing; waiting...')
-        except requests.Timeout as e:
-            logger.debug('Request timeout while testing; waiting...')
-        except requests.HTTPError as e:
-            # http errors come from the web server; so the proxy is
-            # working
-            proc.kill()
-            elapsed_time = time.monotonic() - start_time
-            return ('working', 'http-error', elapsed_time)
-        else:
-            proc.kill()
-            elapsed_time = time.monotonic() - start_time
-            return ('working', 'success', elapsed_time)
-
-        elapsed_time = time.monotonic() - start_time
-        if elapsed_time > TEST_TIMEOUT:
-            proc.kill()
-            return ('not-working', 'timeout', elapsed_time)
-        time.sleep(0.1)
-
-
-def apply_test_android_url(args):
-    return test_android_url(*args)
-
-
 def main():
     config_logging()
 
     redis = get_redis()
 
     logger.info('Retrieving url list...')
-    text = requests.get(SCRAPE_URL).text
-    urls = re.findall(r'ss://.+$', text, re.MULTILINE)
-    logger.info(f'Found {len(urls)} url(s).')
+    urls = sources.fetch_urls(redis, SCRAPE_SOURCES, SCRAPE_TIMEOUT)
+    logger.info('Found %d url(s).', len(urls))
+
+    now = time.time()
+    history = TestHistory(redis, TEST_INTERVAL, TEST_MAX_BACKOFF,
+                          grace=TEST_INTERVAL / 5,
+                          retention=HISTORY_RETENTION)
+    known = history.load()
 
     results = []
-    to_be_tested = {}
+    configs = {}
     for url in urls:
         parsed_url = urlparse(url)
         url_type = detect_url_type(parsed_url)
@@ -169,8 +129,8 @@ def main():
         try:
             config = get_config_from_android_url(parsed_url)
         except SsUrlParseError as e:
-            logger.info(f'Invalid URL: {url}')
-            logger.debug(f'Error: {e}')
+            logger.info('Invalid URL: %s', url)
+            logger.debug('Error: %s', e)
             results.append({
                 'name': parsed_url.hostname,
                 'config': {},
@@ -179,34 +139,57 @@ def main():
                 'response_time': None,
             })
         else:
-            to_be_tested[url] = config
-
-    with Pool(20) as pool:
-        logger.info(f'Testing {len(to_be_tested)} url(s)...')
-        args = [
-            (config, i)
-            for i, config in enumerate(to_be_tested.values())
-        ]
-        for (url, config), (status, error, resp_time) in zip(
-                to_be_tested.items(),
-                pool.imap(apply_test_android_url, args)):
-            results.append({
-                'name': config['title'],
-                'config': config,
-                'status': status,
-                'error': str(error),
-                'response_time': resp_time,
-            })
-            if status == 'working':
-                logger.info(f'{config["name"]}: working')
-            else:
-                logger.info(f'{config["name"]}: {status}   Error: {error}')
+            # duplicates (even under different names) are tested once.
+            configs.setdefault(get_fingerprint(config), config)
+
+    to_be_tested = {
+        fingerprint: config
+        for fingerprint, config in configs.items()
+        if history.is_due(known.get(fingerprint), now)
+    }
+    logger.info('Testing %d of %d unique config(s)...',
+                len(to_be_tested), len(configs))
+    test_results = asyncio.run(engine.test_configs(
+        to_be_tested.values(), TEST_CONCURRENCY, TEST_TIMEOUT))
+
+    records = {
+        fingerprint: known[fingerprint]
+        for fingerprint in configs
+        if fingerprint in known
+    }
+    for (fingerprint, config), (status, error, resp_time) in zip(
+            to_be_tested.items(), test_results):
+        records[fingerprint] = history.update(
+            known.get(fingerprint), status, error, resp_time, now)
+        if status == 'working':
+            logger.info('%s: working', config['name'])
+        else:
+            logger.info('%s: %s   Error: %s',
+                        config['name'], status, error)
+    history.save(records, now)
+    history.prune(known, records, now)
+
+    # the list is made of the latest results of every config in this
+    # run, tested now or not.
+    for fingerprint, config in configs.items():
+        record = records[fingerprint]
+        results.append({
+            'name': config['title'],
+            'config': config,
+            'status': record['status'],
+            'error': record['error'],
+            'response_time': record['response_time'],
+        })
 
     def fix_resp_time(value):
         return value if value is not None else float('inf')
     results.sort(key=lambda r: fix_resp_time(r['response_time']))
 
-    redis.set('vpn:status-list', json.dumps(results))
+    # the version tells the api its cached copy is out of date.
+    pipe = redis.pipeline()
+    pipe.set('vpn:status-list', json.dumps(results))
+    pipe.incr('vpn:status-list:version')
+    pipe.execute()
     logger.info('Done.')
 
 
@@ -1,6 +1,8 @@
+import os
 from flask import Blueprint, Flask, render_template, current_app as app
 from pyutils import env
 from pyutils.env import defenv
+from pyutils.staticfiles import StaticAssets, StaticFile
 
 defenv('WEBSITE_SECRET_KEY', str, optional=False)
 
@@ -8,13 +10,24 @@ bp = Blueprint('website', __name__, url_prefix='/')
 
 
 def create_app():
-    app = Flask(__name__)
+    env.get_config()
+
+    app = Flask(__name__, static_folder=None)
     app.secret_key = env.WEBSITE_SECRET_KEY
     app.register_blueprint(bp)
 
+    app.assets = StaticAssets(os.path.join(app.root_path, 'static'))
+    app.assets.init_app(app)
+
+    # the page is the same for everyone, so it's rendered (and
+    # compressed) only once.
+    with app.app_context():
+        app.home_page = StaticFile(
+            render_template('index.html').encode('utf-8'), 'text/html')
+
     return app
 
 
 @bp.get('/')
 def home_page():
-    return render_template('index.html')
+    return app.home_page.make_response()